@@ -11,8 +11,367 @@ import sys
 import binascii
 import struct
 import os
+import mmap
+import weakref
+import threading
+import zlib
+from collections import OrderedDict
+import numpy as np
 from .utils import dec_debug, do_debug
-from .utils.misc import deprecated, aliased, alias
+from .utils.misc import deprecated, aliased, alias, PB
+
+# Memory maps of the files opened with open_mmap (file object -> memoryview)
+_mmaps = weakref.WeakKeyDictionary()
+
+# Lock used for the reads when positional reads are not available (see pread)
+_read_lock = threading.Lock()
+
+def pread(fp, offset, size):
+    """
+    Read size bytes of the file fp at a given offset without using (nor modifying) the file position.
+    Several threads can thus read concurrently from the same file object.
+    The memory map of the file is used if any (see open_mmap), then os.pread if available.
+    Otherwise the read is protected by a lock.
+    """
+    mm = _mmaps.get(fp)
+    if mm is not None:
+        return mm[offset:offset+size].tobytes()
+    if hasattr(os, 'pread'):
+        data = os.pread(fp.fileno(), size, offset)
+        if len(data) == size or len(data) == 0:
+            return data
+        # a single read can return less than the requested size for very large blocks
+        chunks = [data]
+        while size > len(data):
+            chunk = os.pread(fp.fileno(), size-len(data), offset+len(data))
+            if not chunk:
+                break
+            chunks.append(chunk)
+            data = b''.join(chunks)
+        return data
+    with _read_lock:
+        fp.seek(offset)
+        return fp.read(size)
+
+# Navigation caches of each file (file object -> dict). See get_cache
+_caches = weakref.WeakKeyDictionary()
+
+def get_cache(fp):
+    """
+    Return the navigation cache of a file. It contains:
+        lists: the children list of each container block (block offset -> list)
+        names: the children of each container block indexed by name (block offset -> {name: (entries, {id: bidx})})
+        paths: the resolved paths of Block.goto ((start offset, path, lazy) -> (block offset, parent Block))
+        toc: the table of contents (blocks, children) given to set_toc, if any
+    """
+    if fp not in _caches:
+        _caches[fp] = {'lists': {}, 'names': {}, 'paths': {}}
+    return _caches[fp]
+
+def invalidate_cache(fp):
+    """
+    Clear the navigation cache and the decompressed values cache of a file. Called by all the methods writing to the file.
+    """
+    _caches.pop(fp, None)
+    if fp in _decompressed:
+        _decompressed[fp].clear()
+
+class DecompressCache:
+    """
+    LRU cache of the decompressed values of the blocks of one file, keyed by block offset.
+    The total size of the cached values is bounded by max_bytes (0 disables the cache).
+    It is thread-safe, so that several threads decompressing blocks of the same file can share it.
+    """
+    def __init__(self, max_bytes=2**26):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, offset, load):
+        """
+        Return the cached value of the block at offset. If not cached, it is computed by load() and stored.
+        """
+        with self.lock:
+            if offset in self.data:
+                self.hits += 1
+                self.data.move_to_end(offset)
+                return self.data[offset]
+            self.misses += 1
+        value = load()
+        if len(value) <= self.max_bytes:
+            with self.lock:
+                if offset not in self.data:
+                    self.data[offset] = value
+                    self.size += len(value)
+                self._shrink(self.max_bytes)
+        return value
+
+    def _shrink(self, max_bytes):
+        while self.size > max_bytes:
+            _, value = self.data.popitem(last=False)
+            self.size -= len(value)
+
+    def resize(self, max_bytes):
+        """
+        Change the byte budget of the cache. The least recently used values are dropped if needed.
+        """
+        with self.lock:
+            self.max_bytes = max_bytes
+            self._shrink(max_bytes)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+            self.size = 0
+
+    def stats(self):
+        """
+        Return a dictionary with the number of hits and misses, the number of cached values (entries),
+        their total size in bytes and the byte budget (max_bytes).
+        """
+        with self.lock:
+            return dict(hits=self.hits, misses=self.misses, entries=len(self.data), size=self.size, max_bytes=self.max_bytes)
+
+# Decompressed values caches of each file (file object -> DecompressCache). See get_decompress_cache
+_decompressed = weakref.WeakKeyDictionary()
+
+def get_decompress_cache(fp):
+    """
+    Return the cache of the decompressed block values of a file (see DecompressCache).
+    It is shared by all the Blocks of the file and used by Block.decompress.
+    """
+    if fp not in _decompressed:
+        _decompressed[fp] = DecompressCache()
+    return _decompressed[fp]
+
+def set_decompress_cache(fp, max_bytes):
+    """
+    Set the byte budget of the decompressed values cache of a file. Use 0 to disable it.
+    """
+    get_decompress_cache(fp).resize(max_bytes)
+
+def read_toc(fp, start=8):
+    """
+    Build the table of contents of a file by reading all its blocks in one sequential pass.
+
+    Parameters
+    ----------
+    fp : file object
+        The opened ITA/ITM/ITS file
+    start : int
+        The offset of the first (root) block
+
+    Returns
+    -------
+    blocks : numpy structured array
+        One row per block with the fields offset, type, id, N, length1, length2, next (offset of the continuation block
+        of containers, 0 otherwise), name and path (e.g. "/MassIntervalList/mi[3]/id" with the id of the blocks
+        whose id is not 0 as used by Block.goto, empty for unreachable blocks)
+    children : numpy structured array
+        The children entries of all the containers with the fields parent (offset of the container), type, id, index, slen, blen, bidx and name
+    """
+    size = os.fstat(fp.fileno()).st_size
+    read = lambda offset, length: pread(fp, offset, length)
+    blocks = []
+    children = []
+    offset = start
+    while offset+25 <= size:
+        head = read(offset, 25)
+        if head[1:5] != b'\x19\x00\x00\x00':
+            raise ValueError('Wrong block type ({Type}) found @{pos}'.format(pos=offset, Type=binascii.hexlify(head[1:5])))
+        name_length, ID, N, length1, length2 = struct.unpack('<5x5I', head)
+        name = read(offset+25, name_length)
+        next_block = 0
+        if head[0] in [1, 3]:
+            value = read(offset+25+name_length, length1)
+            next_block = struct.unpack_from('<Q', value, 33)[0]
+            for i in range(N):
+                Type, index, slen, cid, _, blen, bidx = struct.unpack_from('<B4I2Q', value, 41+33*i)
+                children.append((offset, Type, cid, index, slen, blen, bidx, value[index:index+slen]))
+        blocks.append((offset, head[0], ID, N, length1, length2, next_block, name))
+        offset += 25+name_length+length1
+    def width(rows, i):
+        return max([1]+[len(r[i]) for r in rows])
+    blocks = np.array(blocks, dtype=[('offset', '<u8'), ('type', 'u1'), ('id', '<u4'), ('N', '<u4'), ('length1', '<u4'),
+        ('length2', '<u4'), ('next', '<u8'), ('name', 'S{}'.format(width(blocks, 7)))])
+    children = np.array(children, dtype=[('parent', '<u8'), ('type', 'u1'), ('id', '<u4'), ('index', '<u4'), ('slen', '<u4'),
+        ('blen', '<u8'), ('bidx', '<u8'), ('name', 'S{}'.format(width(children, 7)))])
+    # Resolve the path of each block by walking the tree from the root
+    rows = {o: i for i, o in enumerate(blocks['offset'].tolist())}
+    nexts = blocks['next'].tolist()
+    own = {}
+    for parent, name, cid, bidx in zip(*[children[k].tolist() for k in ['parent', 'name', 'id', 'bidx']]):
+        own.setdefault(parent, []).append((name.decode('ascii')+['', '[{}]'.format(cid)][cid != 0], bidx))
+    paths = [''] * len(blocks)
+    todo = [(start, '')]
+    seen = set()
+    while todo:
+        offset, path = todo.pop()
+        while offset in rows and offset not in seen:
+            seen.add(offset)
+            for name, bidx in own.get(offset, []):
+                if bidx in rows and not paths[rows[bidx]]:
+                    paths[rows[bidx]] = path+'/'+name
+                    todo.append((bidx, paths[rows[bidx]]))
+            offset = nexts[rows[offset]]
+    paths = np.array(paths, dtype='U{}'.format(max([1]+[len(p) for p in paths])))
+    from numpy.lib import recfunctions
+    blocks = recfunctions.append_fields(blocks, 'path', paths, usemask=False)
+    return blocks, children
+
+def set_toc(fp, blocks, children):
+    """
+    Fill the navigation cache of a file with the children lists given by a table of contents (see read_toc),
+    so that the containers are not read anymore when navigating in the file.
+    The table is kept in the navigation cache, so that it is dropped as soon as the file is modified (see invalidate_cache).
+    """
+    cache = get_cache(fp)
+    cache['toc'] = (blocks, children)
+    lists = cache['lists']
+    own = {}
+    for parent, index, slen, cid, blen, bidx, name in zip(*[children[k].tolist() for k in ['parent', 'index', 'slen', 'id', 'blen', 'bidx', 'name']]):
+        own.setdefault(parent, []).append({'index': index, 'slen': slen, 'id': cid, 'blen': blen, 'bidx': bidx, 'name': name.decode('ascii')})
+    containers = blocks[np.isin(blocks['type'], [1, 3])]
+    nexts = dict(zip(containers['offset'].tolist(), containers['next'].tolist()))
+    continuations = set(nexts.values())
+    for offset in nexts:
+        if offset in continuations:
+            continue # only the lists of the first chunk of each container are cached
+        L = []
+        chunk = offset
+        while chunk in nexts:
+            L += own.get(chunk, [])
+            chunk = nexts[chunk]
+        lists[offset] = L
+
+def open_mmap(fp):
+    """
+    Memory-map a file opened in read-only mode.
+    All the Blocks subsequently read from fp will parse their header from the map
+    and their value will be a zero-copy memoryview created only when accessed.
+    """
+    if fp not in _mmaps:
+        _mmaps[fp] = memoryview(mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ))
+    return _mmaps[fp]
+
+def close_mmap(fp):
+    """
+    Release the memory map of a file opened by open_mmap (if any).
+    """
+    mm = _mmaps.pop(fp, None)
+    if mm is not None:
+        obj = mm.obj
+        mm.release()
+        try:
+            obj.close()
+        except BufferError:
+            pass # some values are still referenced. The map will be closed by the garbage collector.
+
+# Thread pool shared by all the prefetch calls (created on first use). See get_pool
+_pool = None
+_pool_lock = threading.Lock()
+_pool_workers = os.cpu_count() or 4 # number of threads of the shared pool
+
+def get_pool():
+    """
+    Return the thread pool shared by all the prefetch calls.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            from concurrent.futures import ThreadPoolExecutor
+            _pool = ThreadPoolExecutor(max_workers=_pool_workers)
+        return _pool
+
+def prefetch(fp, offsets, decompress=True, cache=True, workers=None, depth=None):
+    """
+    Read (and decompress) the values of the blocks located at the given offsets concurrently and yield them in order.
+    zlib releases the GIL and the blocks are read with positional reads (see pread), so that the threads share the file.
+
+    Parameters
+    ----------
+    fp : file object
+        The opened ITA/ITM/ITS file
+    offsets : list of int
+        The offsets of the blocks
+    decompress : bool
+        If True the values are decompressed with zlib
+    cache : bool
+        If True the decompressed values are read from and stored in the decompressed values cache of the file (see Block.decompress).
+        Use False for large data read only once (e.g. raw data) in order to keep the cache for the other blocks.
+    workers : None or int
+        The number of threads used. None uses the pool shared by all the prefetch calls (see get_pool)
+        and 1 (or 0) reads the blocks serially in the calling thread.
+    depth : None or int
+        The maximum number of blocks read in advance (which bounds the memory usage). Default: twice the number of threads.
+
+    Returns
+    -------
+    A generator of the block values (bytes) in the order of offsets
+    """
+    def load(offset):
+        B = Block(fp, offset=offset)
+        if not decompress:
+            return bytes(B.value)
+        if cache:
+            return B.decompress()
+        return zlib.decompress(B.value)
+    if workers is not None and workers <= 1:
+        for offset in offsets:
+            yield load(offset)
+        return
+    if workers is None:
+        pool = get_pool()
+        owned = False
+        workers = _pool_workers
+    else:
+        from concurrent.futures import ThreadPoolExecutor
+        pool = ThreadPoolExecutor(max_workers=workers)
+        owned = True
+    if depth is None:
+        depth = 2*workers
+    from collections import deque
+    pending = deque()
+    offsets = iter(offsets)
+    try:
+        for offset in offsets:
+            pending.append(pool.submit(load, offset))
+            if len(pending) >= depth:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+        if owned:
+            pool.shutdown(wait=False)
+
+def copy_range(fp, out, start, size, bufsize=2**24):
+    """
+    Copy size bytes of the file fp starting at offset start to the current position of the file out.
+    os.sendfile is used if available (the data are then copied by the kernel), otherwise the data are copied by chunks of bufsize bytes.
+    """
+    out.flush()
+    if hasattr(os, 'sendfile'):
+        try:
+            while size > 0:
+                n = os.sendfile(out.fileno(), fp.fileno(), start, min(size, bufsize))
+                if n == 0:
+                    break
+                start += n
+                size -= n
+        except OSError:
+            pass # not supported for these files. Copy the remaining data by chunks
+    while size > 0:
+        data = pread(fp, start, min(size, bufsize))
+        if not data:
+            break
+        out.write(data)
+        start += len(data)
+        size -= len(data)
 
 class MissingBlock(Exception):
     def __init__(self, parent, name, index):
@@ -32,10 +391,11 @@ class Block:
     Note: This class was created by reverse engineering on the fileformat of iontof and is most probably not 100% accurate.
     Nevertheless is works in very good agreement with the developer's data.
     """
-    def __init__(self, fp, parent=None):
+    def __init__(self, fp, parent=None, offset=None):
         """
         Init the class
         fp: file pointer (the one created by open(...) of an ITA,ITM,ITS, etc... file pointing at the beginning of a block
+        offset: position of the block in the file. If None, the current position of fp is used.
         
         Each block start with one byte of type followed by 4 bytes that should always be \x19\x00\x00\x00 (all those 5 bytes are saved in self.Type)
         Note: the value \x19\x00\x00\x00 is the unit32 for 25 which is the pre-header length of the block.
@@ -77,6 +437,11 @@ class Block:
         
         Blocks of type \x80\x19\x00\x00\x00 have it's values compressed with zlib (notice the \x78\x5e at the beginning which is typical for zlib encoded data)
             Once decompressed it usually store an array in binary.
+
+        If the file was memory-mapped with pySPM.Block.open_mmap, the header is parsed from the map and the value is a memoryview
+        which is only created when accessed (no data are copied).
+
+        All the reads are positional (see pySPM.Block.pread), so that several threads can read blocks from the same file object.
         """
         self.f = fp
         self.parent = parent
@@ -86,19 +451,44 @@ class Block:
                 self.path = '/'
             else:
                 self.path = parent.path+parent.name+'/'
-        self.offset = self.f.tell()
-        self.Type = self.f.read(5)
+        if offset is None:
+            offset = self.f.tell()
+        self.offset = offset
+        self._mmap = _mmaps.get(self.f)
+        self.Type = self._read(self.offset, 5)
         if self.Type[1:] != b'\x19\x00\x00\x00':
             raise ValueError('Wrong block type ({Type}) found @{pos}'\
                 .format(pos=self.offset, Type=binascii.hexlify(self.Type[1:])))
         if len(self.Type) < 5:
             raise ValueError('EOF reached. Block cannot be read')
         self.head = dict(zip(['name_length', 'ID', 'N', 'length1', 'length2'], \
-            struct.unpack('<5I', self.f.read(20))))
-        self.name = self.f.read(self.head['name_length']).decode('ascii')
-        self.value = self.f.read(self.head['length1'])
+            struct.unpack('<5I', self._read(self.offset+5, 20))))
+        self.name = self._read(self.offset+25, self.head['name_length']).decode('ascii')
+        self._value = None
+        if self._mmap is None:
+            self._value = self._read(self.offset+25+self.head['name_length'], self.head['length1'])
         self.List = None
         self.iterP = 0
+
+    def _read(self, offset, size):
+        """
+        Read size bytes of the file at a given offset (from the memory map if any)
+        """
+        return pread(self.f, offset, size)
+
+    @property
+    def value(self):
+        """
+        The data of the Block (bytes or memoryview if the file is memory-mapped)
+        """
+        if self._value is None:
+            start = self.offset+25+self.head['name_length']
+            self._value = self._mmap[start:start+self.head['length1']]
+        return self._value
+
+    @value.setter
+    def value(self, value):
+        self._value = value
     
     def inc(self):
         """
@@ -159,6 +549,8 @@ class Block:
         if new_name:
             self.f.write(struct.pack("<I", struct.unpack("<I", self.value[:4])[0]-len(blk.name)))
         
+        self.f.flush()
+        invalidate_cache(self.f)
         self.refresh()
         return blk
         
@@ -168,8 +560,10 @@ class Block:
         This function is useful in case a block was overwritten
         """
         self.List = None
-        self.f.seek(self.offset+self.head['name_length']+25)
-        self.value = self.f.read(self.head['length1'])
+        if self._mmap is not None:
+            self._value = None
+            return
+        self.value = self._read(self.offset+self.head['name_length']+25, self.head['length1'])
         
     def edit_child(self, old_block, new_block, debug=False):
         """
@@ -198,6 +592,8 @@ class Block:
                 break
         if not found:
             raise Exception('Child {} not found in {}'.format(old_block.name, self.name))
+        self.f.flush()
+        invalidate_cache(self.f)
         self.refresh()
         
     def create_dir(self, name, children=[], nums=100, assign=True, id=0):
@@ -285,8 +681,8 @@ class Block:
         self.f.write(struct.pack("<B6I", _type, 25, slen, id, 0, size, size))
         self.f.write(name)
         self.f.write(value)
-        self.f.seek(offset)
-        return Block(self.f)
+        self.f.flush()
+        return Block(self.f, offset=offset)
         
     @deprecated("DepthFirstSearch")
     def depth_first_search(self, callback=None, filter=lambda x: True, func=lambda x: x):
@@ -319,29 +715,41 @@ class Block:
         """
         if not self.Type[0:1] in [b'\x01', b'\x03']:
             return []
+        if self.List is None:
+            self.List = get_cache(self.f)['lists'].get(self.offset)
         if self.List is None:
             return self.create_list()
         return self.List
+
+    def _get_children_index(self):
+        """
+        Return the children indexed by name as a dictionary {name: (list of entries, {id: bidx})}
+        """
+        names = get_cache(self.f)['names']
+        if self.offset not in names:
+            index = {}
+            for l in self.get_list():
+                entries, ids = index.setdefault(l['name'], ([], {}))
+                entries.append(l)
+                ids.setdefault(l['id'], l['bidx'])
+            names[self.offset] = index
+        return names[self.offset]
     
     @deprecated("gotoFollowingBlock")
     def goto_following_block(self):
         offset = self.offset+25+self.head['name_length']+self.head['length1']
         if offset < os.fstat(self.f.fileno()).st_size:
-            self.f.seek(offset)
-            return Block(self.f, parent=None)
+            return Block(self.f, parent=None, offset=offset)
         return None
 
     #deprecated("gotoNextBlock")
     def goto_next_block(self):
         offset = self.offset
-        self.f.seek(offset)
-        head = dict(zip(['name_length', 'ID', 'N', 'length1', 'length2'], struct.unpack('<5x5I', self.f.read(25))))
-        name = self.f.read(head['name_length'])
-        length, nums, NextBlock = struct.unpack('<II25xQ', self.f.read(41))
+        head = dict(zip(['name_length', 'ID', 'N', 'length1', 'length2'], struct.unpack('<5x5I', self._read(offset, 25))))
+        length, nums, NextBlock = struct.unpack('<II25xQ', self._read(offset+25+head['name_length'], 41))
         if NextBlock==0:
             return None
-        self.f.seek(NextBlock)
-        return Block(self.f, parent=self.parent)
+        return Block(self.f, parent=self.parent, offset=NextBlock)
     
     def getNthChild(self, n=0):
         L = self.get_list()
@@ -356,41 +764,39 @@ class Block:
         length, nums, next_block = struct.unpack('<II25xQ', self.value[:41])
         self.nums = nums
         offset = self.offset
-        self.List = []
+        List = [] # self.List is only set once complete, so that other threads never see a partial list
         while True:
-            self.f.seek(offset)
-            data = self.f.read(25)
+            data = self._read(offset, 25)
             if len(data)<25:
                 raise Exception('Children of {} @{} cannot be read. Data might be corrupted!'.format(self.name, offset))
             head = dict(zip(['name_length', 'ID', 'N', 'length1', 'length2'], \
                 struct.unpack('<5x5I', data)))
-            name = self.f.read(head['name_length'])
-            data = self.f.tell()
+            data = offset+25+head['name_length']
             length, nums, next_block = \
-                struct.unpack('<II25xQ', self.f.read(41))
+                struct.unpack('<II25xQ', self._read(data, 41))
             N = head['N']
             ## The following is commented as believed to be erroneous
             #if N == 0:
             #    N = nums
             for i in range(N):                
-                self.f.seek(data+42+33*i)
                 S = dict(\
                     zip(['index', 'slen', 'id', 'blen', 'bidx'],\
-                    struct.unpack('<III4xQQ', self.f.read(32))))
-                self.f.seek(data+S['index'])
-                S['name'] = self.f.read(S['slen']).decode('ascii')
-                self.List.append(S)
+                    struct.unpack('<III4xQQ', self._read(data+42+33*i, 32))))
+                S['name'] = self._read(data+S['index'], S['slen']).decode('ascii')
+                List.append(S)
             if next_block == 0:
                 break
             offset = next_block
-        return self.List
+        self.List = List
+        get_cache(self.f)['lists'][self.offset] = List
+        return List
                
     @deprecated("getString")
     def get_string(self):
         """
         Decode the value of the Block to UTF-16 (standard for all strings in this fileformat)
         """
-        return self.value.decode('utf16')
+        return bytes(self.value).decode('utf16')
 
     @deprecated("dictList")
     def dict_list(self):
@@ -400,8 +806,7 @@ class Block:
         """
         d = {}
         for i, l in enumerate(self.get_list()):
-            self.f.seek(l['bidx'])
-            child = Block(self.f, parent=self)
+            child = Block(self.f, parent=self, offset=l['bidx'])
             if child.Type[0:1] == b'\x00':
                 value = binascii.hexlify(child.value)
                 d[child.name] = {'raw':value}
@@ -412,7 +817,7 @@ class Block:
                     d[child.name]['float'] = child.get_double()
                     d[child.name]['long'] = child.get_longlong()
                 if len(child.value)%2 == 0:
-                    d[child.name]['utf16'] = child.value.decode('utf16', "ignore")
+                    d[child.name]['utf16'] = bytes(child.value).decode('utf16', "ignore")
             del child
         return d
     
@@ -424,10 +829,9 @@ class Block:
         """
         print('List of', len(self.get_list()))
         for i, l in enumerate(self.List):
-            self.f.seek(l['bidx'])
             other = ''
             try:
-                child = Block(self.f, parent=self)
+                child = Block(self.f, parent=self, offset=l['bidx'])
                 if child.Type[0:1] == b'\x00':
                     if len(child.value) == 4:
                         vL = child.get_long()
@@ -450,7 +854,7 @@ class Block:
                     if len(value) > 16:
                         value = value[:16]+b'...'
                     if len(child.value)%2 == 0:
-                        vS = child.value.decode('utf16', "ignore")
+                        vS = bytes(child.value).decode('utf16', "ignore")
                         if len(vS) > 20:
                             vS = vS[:20]+'...'
                         print(u"{name} ({id}) <{blen}> @{bidx}, value = {value} (hex) = \"{vS}\" (UTF-16)= {vL} ({Dtype}){other}"\
@@ -486,8 +890,7 @@ class Block:
         name: name of the children's block
         """
         Idx = self.get_index(name, idx, lazy=lazy)
-        self.f.seek(Idx)
-        return Block(self.f, parent=self)
+        return Block(self.f, parent=self, offset=Idx)
 
     @deprecated("getIndex")
     def get_index(self, name, idx=0, lazy=False):
@@ -504,14 +907,14 @@ class Block:
         """
         if type(name) is bytes:
             name = name.decode('ascii')
-        i = 0
-        if name is '*':
+        if name == '*':
             return self.get_list()[idx]['bidx']
-        for l in self.get_list():
-            if l['name'] == name:
-                if (lazy and i==idx) or (not lazy and l['id'] == idx):
-                    return l['bidx']
-                i+=1
+        entries, ids = self._get_children_index().get(name, ([], {}))
+        if lazy:
+            if idx < len(entries):
+                return entries[idx]['bidx']
+        elif idx in ids:
+            return ids[idx]
         raise MissingBlock(self, name, idx)
        
     def goto(self, path, lazy=False):
@@ -530,8 +933,12 @@ class Block:
             path = path[1:]
         if path == '':
             return self
-        self.f.seek(self.offset)
-        s = Block(self.f)
+        paths = get_cache(self.f)['paths']
+        key = (self.offset, path, lazy)
+        if key in paths:
+            offset, parent = paths[key]
+            return Block(self.f, parent=parent, offset=offset)
+        s = Block(self.f, offset=self.offset)
         for p in path.split('/'):
             idx = 0
             if '[' in p and p[-1] == ']':
@@ -543,6 +950,7 @@ class Block:
                 p = e['name']
                 idx = e['id']
             s = s.goto_item(p, idx, lazy=lazy)
+        paths[key] = (s.offset, s.parent)
         return s
 
     @deprecated("getLongLong")
@@ -604,14 +1012,14 @@ class Block:
         Note that the function has no idea if the data are stored as so.
         """
         L = struct.unpack("<I", self.value[offset:offset+4])[0]
-        Key = self.value[offset+4:offset+4+L].decode('utf16', 'ignore')
+        Key = bytes(self.value[offset+4:offset+4+L]).decode('utf16', 'ignore')
         int_value, float_value = struct.unpack("<2xqd", self.value[offset+4+L:offset+22+L])
         L2 = struct.unpack("<I", self.value[offset+22+L:offset+26+L])[0]
-        SVal = self.value[offset+26+L:offset+26+L+L2].decode('utf16', 'ignore')
+        SVal = bytes(self.value[offset+26+L:offset+26+L+L2]).decode('utf16', 'ignore')
         return {'key':Key, 'float':float_value, 'int':int_value,'string':SVal}
 
     def __contains__(self, name):
-        return name in [x['name'] for x in self.get_list()]
+        return name in self._get_children_index()
         
     def show(self, maxlevel=3, level=0, all=False, out=sys.stdout, digraph=False, parent=None, ex=None, **kargs):
         """
@@ -662,8 +1070,38 @@ class Block:
         return r
 
     def decompress(self):
-        import zlib
-        return zlib.decompress(self.value)
+        """
+        Return the zlib-decompressed value of the Block.
+        The result is kept in the LRU cache of the file (see get_decompress_cache), so that blocks read again are not decompressed twice.
+        """
+        return get_decompress_cache(self.f).get(self.offset, lambda: zlib.decompress(self.value))
+
+    def get_array(self, dtype='I', shape=None, decompress=True):
+        """
+        Return the (decompressed) value of the Block as a numpy array without any copy (see numpy.frombuffer).
+        Note that the returned array is read-only.
+
+        Parameters
+        ----------
+        dtype : string or numpy dtype
+            The data type. A single struct format character (e.g. "I", "f", "d", "B") is interpreted as little endian
+            with the standard struct size.
+        shape : None or tuple
+            If not None the array is reshaped to the given shape
+        decompress : bool
+            If True the value is decompressed with zlib first
+        """
+        if decompress:
+            raw = self.decompress()
+        else:
+            raw = self.value
+        if type(dtype) is str and len(dtype) == 1:
+            dtype = '<'+{'l': 'i4', 'L': 'u4'}.get(dtype, dtype)
+        dtype = np.dtype(dtype)
+        data = np.frombuffer(raw, dtype=dtype, count=len(raw)//dtype.itemsize)
+        if shape is not None:
+            data = data.reshape(shape)
+        return data
 
     @deprecated("getData")
     def get_data(self, fmt="I", decompress=True):
@@ -681,79 +1119,300 @@ class Block:
         # set pointer at beginning of data
         self.f.seek(self.offset+25+self.head['name_length'])
         self.f.write(content)
+        self.f.flush()
+        invalidate_cache(self.f)
         self.refresh()
             
     def modify_block_and_export(self, path, new_data, output, debug=False, prog=False, lazy=False):
+        """
+        Export the file to output with the value of the block at path replaced by new_data (which can have a different length).
+        See modify_blocks_and_export.
+        """
+        self.modify_blocks_and_export({path: new_data}, output, debug=debug, prog=prog, lazy=lazy)
+
+    def modify_blocks_and_export(self, changes, output, toc=None, debug=False, prog=False, lazy=False, bufsize=2**24):
+        """
+        Export the file to output with the values of several blocks replaced (by data of any length).
+        The unchanged byte ranges are copied in large chunks (with os.sendfile if available) and only the containers
+        pointing to shifted blocks are rewritten, so that the memory usage does not depend on the file size.
+
+        Parameters
+        ----------
+        changes : dict or list of tuples
+            The new values given by path (relative to the current block) as {path: new_data} or [(path, new_data), ...]
+        output : string
+            The path of the exported file. It should not exist.
+        toc : None or tuple
+            The table of contents of the file (see read_toc). If None it is built.
+        debug : bool
+            If True display the modified blocks
+        prog : bool
+            If True display a progressbar
+        lazy : bool
+            Passed to goto in order to find the blocks
+        bufsize : int
+            Size of the chunks used to copy the unchanged data
+        """
         assert not os.path.exists(output) # Avoid to erase an existing file. Erase it outside the library if needed.
-        out = open(output, 'wb')
-        out.write(b'ITStrF01')
-        block = self.goto(path, lazy=lazy)
-        block_offset = block.offset
-        length_diff = len(new_data)-len(block.value)
-        self.f.seek(8)
-        FILE_SIZE =  os.fstat(self.f.fileno()).st_size
-        if prog:
-            try:
-                from tqdm import tqdm_notebook as tqdm
-            except:
-                from tqdm import tqdm as tqdm
-            T = tqdm(total=FILE_SIZE)
-        debug_msg = ["FileSize: "+str(FILE_SIZE)]
-        if debug:
-            print("File Size",FILE_SIZE)
-        curr = 8
-        if prog:
-            T.update(8)
-        while self.f.tell() < FILE_SIZE:
-            debug_msg = debug_msg[-30:]
-            if prog:
-                ncurr = self.f.tell()
-                T.update(ncurr-curr)
-                curr = ncurr
-            debug_msg.append("Current position: @"+str(self.f.tell()))
-            try:
-                current = Block(self.f) # Here we don't care about the parent argument. It is used only for debug purpose anyway.
-            except Exception as ex:
-                print("Error found! Debug info")
-                for x in debug_msg:
-                    print("\t"+x)
-                raise ex
-            self.f.seek(current.offset)
-            curr_block_length = current.head['length1'] + current.head['name_length'] + 25
-            debug_msg.append('Block Name: "{}" / length: {}'.format(current.name, curr_block_length))
-            if current.offset == block_offset: # Found the block to change
-                debug_msg.append("Block to change FOUND!")
-                out.write(self.f.read(5)) # Write block type
-                out.write(struct.pack("<5I",block.head['name_length'],block.head['ID'],block.head['N'], length_diff+block.head['length1'], length_diff+block.head['length2']))
-                self.f.read(20) # Skip header
-                out.write(self.f.read(block.head['name_length'])) # copy block name
-                self.f.read(block.head['length1']) # skip data in source
-                out.write(new_data) # write new_data
-            elif current.Type[0] in [1,3]: # found a container, check for references to block after the modified block
-                debug_msg.append("Block container found. Checking children...")
-                out.write(self.f.read(25)) # copy header
-                out.write(self.f.read(current.head['name_length'])) # copy block name
-                SubHeader = list(struct.unpack('<2I5s5IQ', self.f.read(41) )) # read sub-block header
-                if SubHeader[8] > block_offset: # Is the nextbloxk after the modified block? Yes => Adjust the offset position
-                    SubHeader[8] += length_diff
-                out.write(struct.pack('<2I5s5IQ', *SubHeader )) # write sub-block header
-                N = current.head['N']
-                #if N == 0:
-                #    N = SubHeader[1]
-                for i in range(N):
-                    X, index, slen, id,Y, blen, bidx = struct.unpack('<B4I2Q', self.f.read(33))
-                    if bidx == block_offset: # If the children block is the modified block, adjust length
-                        blen = len(new_data)
-                    elif bidx > block_offset: # If the children is after the modifien block, adjust its offset
-                        bidx += length_diff
-                    out.write(struct.pack('<B4I2Q',X, index, slen, id, Y,blen, bidx)) # write child info
-                # Write the extra bytes used by iontof which seems to be useless as well as the childrens' name
-                delta = curr_block_length - (self.f.tell() - current.offset) # number of bytes remaining till the end of the block
-                out.write(self.f.read(delta))
-            else:
-                debug_msg.append("Data Block found. Copy data without check...")
-                out.write(self.f.read(curr_block_length))
+        if isinstance(changes, dict):
+            changes = list(changes.items())
+        new_values = {}
+        for path, new_data in changes:
+            new_values[self.goto(path, lazy=lazy).offset] = new_data
+        if toc is None:
+            toc = read_toc(self.f)
+        blocks, children = toc
+        rows = dict(zip(blocks['offset'].tolist(), range(len(blocks))))
+        changed = np.array(sorted(new_values), dtype=np.uint64)
+        deltas = np.cumsum([len(new_values[o])-int(blocks['length1'][rows[o]]) for o in changed.tolist()])
+        def shift(offsets):
+            # offset of the blocks in the exported file (blocks located after the changed blocks are shifted)
+            offsets = np.asarray(offsets, dtype=np.uint64)
+            i = np.searchsorted(changed, offsets, side='left')
+            return (offsets.astype(np.int64)+np.concatenate([[0], deltas])[i]).astype(np.uint64)
+        # Only the containers pointing to (or after) a changed block have to be patched
+        first = changed[0]
+        patched = set(children['parent'][children['bidx'] >= first].tolist())
+        patched |= set(blocks['offset'][blocks['next'] >= first].tolist())
+        special = sorted(patched | set(new_values))
+        FILE_SIZE = os.fstat(self.f.fileno()).st_size
+        T = None
         if prog:
-            T.update(FILE_SIZE-curr)
+            T = PB(total=FILE_SIZE, unit='B', unit_scale=True)
+        with open(output, 'wb') as out:
+            pos = 0
+            for offset in special:
+                copy_range(self.f, out, pos, offset-pos, bufsize=bufsize)
+                head = pread(self.f, offset, 25)
+                name_length, length1 = struct.unpack_from("<I", head, 5)[0], struct.unpack_from("<I", head, 17)[0]
+                head = bytearray(head+pread(self.f, offset+25, name_length))
+                if offset in new_values:
+                    new_data = new_values[offset]
+                    if do_debug(debug):
+                        print("Modify block \"{}\" @{} ({} -> {} bytes)".format(head[25:].decode('ascii'), offset, length1, len(new_data)))
+                    length2 = struct.unpack_from("<I", head, 21)[0]
+                    struct.pack_into("<2I", head, 17, len(new_data), length2+len(new_data)-length1)
+                    out.write(head)
+                    out.write(new_data)
+                else:
+                    value = bytearray(pread(self.f, offset+25+name_length, length1))
+                    N = struct.unpack_from("<I", head, 13)[0]
+                    Next = struct.unpack_from("<Q", value, 33)[0]
+                    if Next:
+                        struct.pack_into("<Q", value, 33, int(shift([Next])[0]))
+                    if N > 0:
+                        entries = np.frombuffer(value, dtype=[('type', 'u1'), ('index', '<u4'), ('slen', '<u4'), ('id', '<u4'), ('flag', '<u4'),
+                            ('blen', '<u8'), ('bidx', '<u8')], count=N, offset=41).copy()
+                        for i, bidx in enumerate(entries['bidx'].tolist()):
+                            if bidx in new_values:
+                                entries['blen'][i] = len(new_values[bidx])
+                        entries['bidx'] = shift(entries['bidx'])
+                        value[41:41+33*N] = entries.tobytes()
+                    out.write(head)
+                    out.write(value)
+                    length1 = len(value)
+                pos = offset+25+name_length+length1
+                if T is not None:
+                    T.update(pos-T.n)
+            copy_range(self.f, out, pos, FILE_SIZE-pos, bufsize=bufsize)
+        if T is not None:
+            T.update(FILE_SIZE-T.n)
             T.close()
-        out.close()
+
+class BlockWriter:
+    """
+    Collect edits of blocks in memory and commit them to the file in one pass.
+    All the new blocks (directories and values) are appended contiguously at the end of the file with a single write,
+    the blocks of the same size are rewritten in place and the children table of each existing container is patched once.
+
+    Usage:
+        with BlockWriter(root) as w:
+            w.edit_block("MassIntervalList/mi[12]", "id", struct.pack("<I", 12))
+            ...
+    The edits are committed when leaving the with statement (if no exception occurred) or by calling commit().
+    """
+    def __init__(self, root):
+        self.root = root
+        self.f = root.f
+        self.rewrites = OrderedDict() # offset of the rewritten blocks -> (Block, new value)
+        self.parents = OrderedDict() # offset of the existing containers -> {'block': Block, 'new': {(name, id): node}, 'replace': {old offset: node}}
+        self.blocks = [] # the new blocks in the order they will be written
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+
+    def _new(self, name, id, _type, value=None):
+        node = {'name': name, 'id': id, 'type': _type, 'value': value, 'children': OrderedDict()}
+        self.blocks.append(node)
+        return node
+
+    def _existing(self, blk):
+        if blk.offset not in self.parents:
+            self.parents[blk.offset] = {'block': blk, 'new': OrderedDict(), 'replace': {}}
+        return self.parents[blk.offset]
+
+    def edit_block(self, path, name, value, id=0, _type=0, force=False):
+        """
+        Same as Block.edit_block, but the edit is only recorded and will be written by commit().
+        The missing directories of path are created.
+        """
+        parent = self.root
+        if path != '':
+            for p in path.split('/'):
+                idx = 0
+                if '[' in p and p[-1] == ']':
+                    i = p.index('[')
+                    idx = int(p[i+1:-1])
+                    p = p[:i]
+                if isinstance(parent, Block):
+                    if p == '*':
+                        e = parent.get_list()[idx]
+                        p = e['name']
+                        idx = e['id']
+                    new = self._existing(parent)['new']
+                    if (p, idx) in new:
+                        parent = new[(p, idx)]
+                        continue
+                    try:
+                        parent = parent.goto_item(p, idx)
+                    except MissingBlock:
+                        parent = new[(p, idx)] = self._new(p, idx, 1)
+                else:
+                    if (p, idx) not in parent['children']:
+                        parent['children'][(p, idx)] = self._new(p, idx, 1)
+                    parent = parent['children'][(p, idx)]
+        key = (name, id)
+        if not isinstance(parent, Block):
+            children = parent['children']
+        else:
+            pending = self._existing(parent)
+            children = pending['new']
+            if key not in children:
+                try:
+                    child = parent.goto_item(name, id)
+                except MissingBlock:
+                    child = None
+                if child is not None:
+                    if child.offset in pending['replace']:
+                        pending['replace'][child.offset].update(type=_type, value=value)
+                    elif child.head['length1'] == len(value):
+                        self.rewrites[child.offset] = (child, value)
+                    elif force:
+                        pending['replace'][child.offset] = self._new(name, id, _type, value)
+                    else:
+                        raise Exception("Use the force=True parameter if you wish to replace an existing block with another data size")
+                    return
+        if key in children:
+            children[key].update(type=_type, value=value)
+        else:
+            children[key] = self._new(name, id, _type, value)
+
+    @staticmethod
+    def _entry(node):
+        return node['type'], node['id'], [0,1][node['type'] in [0,128]], len(node['value']), node['offset']
+
+    def _patch(self, pending):
+        """
+        Compute the new values of the chunks of an existing container with its new and replaced children.
+        Return a list of (chunk Block, new N, new value).
+        """
+        chunks = [pending['block']]
+        while True:
+            nxt = chunks[-1].goto_next_block()
+            if nxt is None:
+                break
+            chunks.append(nxt)
+        result = []
+        for chunk in chunks:
+            value = bytearray(chunk.value)
+            N = chunk.head['N']
+            names = {}
+            for i in range(N):
+                entry = list(struct.unpack_from("<B4I2Q", value, 41+33*i))
+                names.setdefault(bytes(value[entry[1]:entry[1]+entry[2]]), entry[1])
+                if entry[6] in pending['replace']:
+                    node = pending['replace'][entry[6]]
+                    entry[5], entry[6] = len(node['value']), node['offset']
+                    struct.pack_into("<B4I2Q", value, 41+33*i, *entry)
+            if chunk is chunks[-1] and pending['new']:
+                lowest_index = struct.unpack_from("<I", value)[0]
+                for node in pending['new'].values():
+                    name = node['name'].encode('utf8')
+                    if name not in names:
+                        lowest_index -= len(name)
+                        names[name] = lowest_index
+                        value[lowest_index:lowest_index+len(name)] = name
+                    if 41+33*(N+1) > lowest_index:
+                        raise Exception("Block is too small to fit the data.")
+                    Type, id, flag, blen, bidx = self._entry(node)
+                    struct.pack_into("<B4I2Q", value, 41+33*N, Type, names[name], len(name), id, flag, blen, bidx)
+                    N += 1
+                struct.pack_into("<I", value, 0, lowest_index)
+            result.append((chunk, N, bytes(value)))
+        return result
+
+    def commit(self):
+        """
+        Write all the recorded edits to the file.
+        """
+        # The directories are sized to hold all their children (with at least the default room of Block.create_dir)
+        for node in self.blocks:
+            if node['type'] in [1,3]:
+                names = set(n['name'] for n in node['children'].values())
+                needed = 41+33*len(node['children'])+sum(len(n.encode('utf8')) for n in names)
+                nums = max(100, -(-needed//53))
+                node['value'] = bytes(53*nums)
+        self.f.seek(0, 2)
+        offset = self.f.tell()
+        for node in self.blocks:
+            node['offset'] = offset
+            offset += 25+len(node['name'].encode('utf8'))+len(node['value'])
+        data = []
+        for node in self.blocks:
+            name = node['name'].encode('utf8')
+            value = node['value']
+            if node['type'] in [1,3]:
+                value = bytearray(value)
+                nums = len(value)//53
+                index = len(value)
+                names = {}
+                for i, child in enumerate(node['children'].values()):
+                    cname = child['name'].encode('utf8')
+                    if cname not in names:
+                        index -= len(cname)
+                        names[cname] = index
+                        value[index:index+len(cname)] = cname
+                    Type, id, flag, blen, bidx = self._entry(child)
+                    struct.pack_into("<B4I2Q", value, 41+33*i, Type, names[cname], len(cname), id, flag, blen, bidx)
+                struct.pack_into("<2I", value, 0, index, nums)
+            data.append(struct.pack("<B6I", node['type'], 25, len(name), node['id'], len(node['children']), len(value), len(value)))
+            data.append(name)
+            data.append(bytes(value))
+        # All the checks are performed before writing anything
+        patches = [self._patch(pending) for pending in self.parents.values() if pending['new'] or pending['replace']]
+        self.f.write(b''.join(data))
+        for offset in sorted(self.rewrites):
+            blk, value = self.rewrites[offset]
+            self.f.seek(offset+25+blk.head['name_length'])
+            self.f.write(value)
+        for patch in patches:
+            for chunk, N, value in patch:
+                self.f.seek(chunk.offset+13)
+                self.f.write(struct.pack("<I", N))
+                self.f.seek(chunk.offset+25+chunk.head['name_length'])
+                self.f.write(value)
+                chunk.head['N'] = N
+        self.f.flush()
+        invalidate_cache(self.f)
+        for patch in patches:
+            for chunk, N, value in patch:
+                chunk.refresh()
+        for blk, value in self.rewrites.values():
+            blk.refresh()
+        self.rewrites = OrderedDict()
+        self.parents = OrderedDict()
+        self.blocks = []
@@ -18,8 +18,10 @@ import copy
 from .ITM import ITM
 from .collection import Collection
 from .SPM import SPM_image
-from .Block import MissingBlock
+from .Block import MissingBlock, Block, BlockWriter, prefetch
 from .utils.misc import deprecated, aliased, alias, PB
+from .utils.math import shift_sum
+from .utils.cache import cached
 import warnings
 
 @aliased
@@ -72,7 +74,7 @@ class ITA(ITM):
         """
         try:
             X, Y = self.size['pixels']['x'], self.size['pixels']['y']
-            img = self.image(np.flipud(np.array(self.root.goto('Meta/SI Image/intensdata').get_data("f"), dtype=np.float32).reshape((Y, X))), channel="SI count")
+            img = self.image(np.flipud(self.root.goto('Meta/SI Image/intensdata').get_array("f", (Y, X)).copy()), channel="SI count")
         except Exception as e:
             try:
                 img = self.get_added_image(0).pixels
@@ -269,15 +271,14 @@ class ITA(ITM):
             scans = range(self.Nscan)
         if type(scans) == int:
             scans = [scans]
-        if prog:
-            scans= PB(scans)
 
         Z = np.zeros((self.sy, self.sx))
-        for s in scans:
-            node = self.root.goto("filterdata/TofCorrection/ImageStack/Reduced Data/Images/{SN}/ScanData/EDROff/{scan}".format(SN=SN, scan=s))
-            dat = node.decompress()
-            data = struct.unpack("<{}I".format(len(dat)//4), dat)
-            Z += np.array(data, dtype=np.float).reshape((self.sy, self.sx))
+        offsets = [self.root.goto("filterdata/TofCorrection/ImageStack/Reduced Data/Images/{SN}/ScanData/EDROff/{scan}".format(SN=SN, scan=s)).offset for s in scans]
+        images = prefetch(self.f, offsets)
+        if prog:
+            images = PB(images, total=len(offsets))
+        for data in images:
+            Z += np.frombuffer(data, dtype='<u4', count=self.sx*self.sy).reshape((self.sy, self.sx))
         if raw:
             return Z
         channel = self.get_channel_by_sn(SN)
@@ -416,6 +417,7 @@ class ITA(ITM):
         return out
 
     @alias("getAddedImageByName")
+    @cached
     def get_added_image_by_name(self, names, strict=False, raw=False, **kargs):
         """
         Retrieve the image for the sum of all scan (precomputed by iontof, but not shift-corrected) for given names
@@ -460,11 +462,10 @@ class ITA(ITM):
             each tuple is a (Δx,Δy) in pixels (one for each scan).
         """
         try:
-            X = zlib.decompress(self.root.goto('filterdata/TofCorrection/ImageStack/Reduced Data'
-                                           '/ImageStackScans/ShiftCoordinates/ImageStack.ShiftCoordinates').value)
+            D = self.root.goto('filterdata/TofCorrection/ImageStack/Reduced Data'
+                               '/ImageStackScans/ShiftCoordinates/ImageStack.ShiftCoordinates').get_array('i').tolist()
         except:
             return [(0,0) for x in range(self.Nscan)]
-        D = struct.unpack('<'+str(len(X)//4)+'i', X)
         dx = D[::2]
         dy = D[1::2]
         return list(zip(dx, dy))
@@ -498,6 +499,7 @@ class ITA(ITM):
         return self.image(np.flipud(Z), channel="Masses: "+",".join(channels_name))
 
     @alias("getAddedImageByMass")
+    @cached
     def get_added_image_by_mass(self, masses, raw=False, **kargs):
         """
         Retrieve the image for the sum of all scan (precomputed by iontof, but not shift-corrected) for (a) given masse(s)
@@ -550,6 +552,7 @@ class ITA(ITM):
                     return name
 
     @alias("get_added_image_by_sn","getAddedImageBySN")
+    @cached
     def get_added_image_by_SN(self, SN, raw=False):
         """
         New ITA fileformat save images with their respective serial number (SN).
@@ -561,9 +564,7 @@ class ITA(ITM):
         SN: Serial Number of the channel
         """
         node = self.root.goto("filterdata/TofCorrection/ImageStack/Reduced Data/Images/{SN}/SumImage/EDROff".format(SN=SN))
-        dat = node.decompress()
-        data = struct.unpack("<{}I".format(len(dat)//4), dat)
-        img = np.array(data, dtype=np.float).reshape((self.sy, self.sx))
+        img = node.get_array('I', (self.sy, self.sx)).astype(np.float64)
         if raw:
             return img
         channel = self.get_channel_by_SN(SN)
@@ -579,13 +580,75 @@ class ITA(ITM):
         assert channel >= 0 and channel < self.Nimg
         c = self.root.goto('filterdata/TofCorrection/ImageStack/Reduced Data/ImageStackScansAdded'
                            '/Image['+str(channel)+']/ImageArray.Long')
-        D = zlib.decompress(c.value)
-        V = np.array(struct.unpack('<'+str(self.sx*self.sy)+'I', D),
-                     dtype=np.float).reshape((self.sy, self.sx))
+        V = c.get_array('I', (self.sy, self.sx)).astype(np.float64)
         return V
     
+    def _load_images(self, offsets, prog=False, workers=None):
+        """
+        Decompress the images (ImageArray.Long blocks) located at the given offsets.
+        Return a (len(offsets), sy, sx) uint32 array.
+        """
+        cube = np.zeros((len(offsets), self.sy, self.sx), dtype=np.uint32)
+        data = prefetch(self.f, offsets, workers=workers)
+        if prog:
+            data = PB(data, total=len(offsets), leave=False)
+        for i, raw in enumerate(data):
+            cube[i] = np.frombuffer(raw, dtype='<u4', count=self.sx*self.sy).reshape((self.sy, self.sx))
+        return cube
+
+    @alias("getImageCube")
+    def get_image_cube(self, channels=None, scans=None, prog=False, workers=None):
+        """
+        Retrieve at once the images of several channels for several scans.
+
+        Parameters
+        ----------
+        channels : None, int or list of int
+            The channel IDs. If None all the channels are loaded
+        scans : None, int or list of int
+            The scans. If None all the scans are loaded
+        prog : bool
+            Display a progressbar
+        workers : None or int
+            The number of threads decompressing the images. None uses the shared pool of pySPM.Block.prefetch
+            and 1 decompresses them serially
+
+        Returns
+        -------
+        4D numpy array
+            uint32 array of shape (channels, scans, sy, sx)
+        """
+        if channels is None:
+            channels = range(self.Nimg)
+        if scans is None:
+            scans = range(self.Nscan)
+        if type(channels) is int:
+            channels = [channels]
+        if type(scans) is int:
+            scans = [scans]
+        base = self.root.goto('filterdata/TofCorrection/ImageStack/Reduced Data/ImageStackScans')
+        offsets = []
+        for channel in channels:
+            im_root = base.goto_item('Image', channel)
+            offsets += [im_root.get_index('ImageArray.Long', scan) for scan in scans]
+        return self._load_images(offsets, prog=prog, workers=workers).reshape((len(channels), len(scans), self.sy, self.sx))
+
+    @alias("getAddedImageCube")
+    def get_added_image_cube(self, channels=None, prog=False, workers=None):
+        """
+        Retrieve at once the images of several channels for the sum of all scans (precomputed by iontof, but not shift-corrected).
+        Similar to pySPM.ITA.get_image_cube, but return a uint32 array of shape (channels, sy, sx)
+        """
+        if channels is None:
+            channels = range(self.Nimg)
+        if type(channels) is int:
+            channels = [channels]
+        base = self.root.goto('filterdata/TofCorrection/ImageStack/Reduced Data/ImageStackScansAdded')
+        offsets = [base.goto_item('Image', channel).get_index('ImageArray.Long') for channel in channels]
+        return self._load_images(offsets, prog=prog, workers=workers)
+
     @alias("fastGetImage")
-    def fast_get_image(self, channel, scans, shifts=False, prog=False, **kargs):
+    def fast_get_image(self, channel, scans, shifts=False, prog=False, workers=None, **kargs):
         """
         Retieve a 2D numpy array corresponding to a given channel ID for given scan(s) and return their sum.
 
@@ -597,9 +660,11 @@ class ITA(ITM):
             List of scans
         shifts : False or list of tuples
             List of the shift correction in pixels for ALL the scans ( not only the selected ones).
-            If Flase not shift correction is performed
+            If Flase not shift correction is performed. Sub-pixel shifts are interpolated (see pySPM.utils.shift_sum)
         prog : bool
             Display a progressbar ?
+        workers : None or int
+            The number of threads decompressing the images (see pySPM.ITA.get_image_cube)
 
         Returns
         -------
@@ -611,21 +676,14 @@ class ITA(ITM):
             shifts = kargs.pop("Shifts")
             
         Z = np.zeros((self.sy, self.sx))
-        if prog:
-            scans = PB(scans)
-            
-        im_root =  self.root.goto('filterdata/TofCorrection/ImageStack/Reduced Data/ImageStackScans/Image['+str(channel)+']')
-        for scan in scans:
-            c = im_root.goto('ImageArray.Long['+str(scan)+']')
-            V = np.array(c.get_data('I'), dtype=np.float).reshape((self.sy, self.sx))
-            if shifts:
-                r = [int(z) for z in shifts[scan]]
-                V = np.roll(np.roll(V, -r[0], axis=1), -r[1], axis=0)
-                rx = [max(0,-r[0]), self.sx-max(1,r[0])]
-                ry = [max(0,-r[1]), self.sy-max(1,r[1])]
-                Z[ry[0]:ry[1],rx[0]:rx[1]] += V[ry[0]:ry[1],rx[0]:rx[1]]
-            else:
-                Z += V
+        if type(scans) is int:
+            scans = [scans]
+        scans = list(scans)
+        cube = self.get_image_cube(channel, scans, prog=prog, workers=workers)[0]
+        if shifts:
+            shift_sum(cube, [shifts[scan] for scan in scans], out=Z)
+        else:
+            Z += cube.sum(axis=0)
         return Z
         
     @alias("getImage")
@@ -661,21 +719,18 @@ class ITA(ITM):
         assert scan >= 0 and scan < self.Nscan
         c = self.root.goto('filterdata/TofCorrection/ImageStack/Reduced Data/ImageStackScans'
                            '/Image['+str(channel)+']/ImageArray.Long['+str(scan)+']')
-        V = np.array(c.get_data(), dtype=np.float).reshape((self.sy, self.sx))
+        V = c.get_array('I', (self.sy, self.sx)).astype(np.float64)
         if not shifts is None:
-            r = [int(z) for z in shifts[scan]]
-            V = np.roll(np.roll(V, -r[0], axis=1), -r[1], axis=0)
             if shift_mode == 'const' or shift_mode == 'NaN':
                 if shift_mode == 'NaN':
                     const = np.nan
-                if r[1] < 0:
-                    V[:-r[1], :] = const
-                elif r[1] > 0:
-                    V[-r[1]:, :] = const
-                if r[0] < 0:
-                    V[:, :-r[0]] = const
-                elif r[0] > 0:
-                    V[:, -r[0]:] = const
+                # pixels not fully covered by the shifted image are replaced by const
+                covered = shift_sum(np.ones((1,)+V.shape), [shifts[scan]])
+                V = shift_sum(V[np.newaxis], [shifts[scan]])
+                V[covered < 1-1e-9] = const
+            else:
+                r = [int(z) for z in shifts[scan]]
+                V = np.roll(np.roll(V, -r[0], axis=1), -r[1], axis=0)
         return V
         
     @alias("getOperation")
@@ -703,7 +758,7 @@ class ITA(ITM):
         sett = self.root.goto('Presentation/Imaging Worksheet/Worksheet/PAGES/Page[{}]/SETTINGS'.format(page)).dict_list()
         Nx = sett['Xsize']['ulong']
         Ny = sett['Ysize']['ulong']
-        items = self.root.goto('Presentation/Imaging Worksheet/Worksheet/PAGES/Page[{}]/Items'.format(page)).get_data()
+        items = self.root.goto('Presentation/Imaging Worksheet/Worksheet/PAGES/Page[{}]/Items'.format(page)).get_array('I')
         ax = sp(len(items))
         IntV = {}
         for x in self.root.goto("MassIntervalList"):
@@ -718,11 +773,11 @@ class ITA(ITM):
                 if OPTYPE == 4:
                     blk = self.getOperation(blk.goto_item('ArgOpIDs').get_ulong())
                 elif OPTYPE==3:
-                    palette = np.array(blk.goto_item('BMP-Palette').get_data('B')).reshape((256, 4))
+                    palette = blk.goto_item('BMP-Palette').get_array('B', (256, 4))
                     B, G, R = palette[:, 0], palette[:, 1], palette[:, 2]
                     dimx = blk.goto('Cache/IImage-Cache-DimX').get_ulong()
                     dimy = blk.goto('Cache/IImage-Cache-DimY').get_ulong()
-                    img = np.array(blk.goto('Cache/IImage-Cache-Intensities').get_data('d')).reshape((dimy, dimx))
+                    img = blk.goto('Cache/IImage-Cache-Intensities').get_array('d', (dimy, dimx))
                     RGB = np.hstack([R[:, None], G[:, None], B[:, None]])/256
                     cm = mpl.colors.ListedColormap(RGB)
                     ax[i].imshow(img, cmap=cm)
@@ -744,36 +799,38 @@ class ITA(ITM):
         if scans is not None:
             N = self.root.goto("filterdata/TofCorrection/ImageStack/Reduced Data/ImageStackScans/Image.NumberOfImages").get_ulong()
         AN = self.root.goto("filterdata/TofCorrection/ImageStack/Reduced Data/ImageStackScansAdded/Image.NumberOfImages").get_ulong()
-        self.root.edit_block("filterdata/TofCorrection/ImageStack/Reduced Data/ImageStackScansAdded/Image[{}]".format(AN), "Image.MassIntervalSN", SN.encode('utf8'))
-        self.root.edit_block("filterdata/TofCorrection/ImageStack/Reduced Data/ImageStackScansAdded/Image[{}]".format(AN), "Image.XSize", struct.pack("<I", sx))
-        self.root.edit_block("filterdata/TofCorrection/ImageStack/Reduced Data/ImageStackScansAdded/Image[{}]".format(AN), "Image.YSize", struct.pack("<I", sy))
-        if scans is not None:
-            RS = range(self.Nscan)
-            if prog:
-                RS = PB(RS)
-            for i in RS:
-                img = np.flipud(scans[i].astype(np.uint32, casting='unsafe'))
-                data = zlib.compress(struct.pack("<{}I".format(sx*sy), *np.ravel(img)), level=lvl)
-                self.root.edit_block("filterdata/TofCorrection/ImageStack/Reduced Data/ImageStackScans/Image[{}]".format(N), "ImageArray.Long", data, id=i, _type=128)
-                if added is None:
-                    added_img += img
-
-        if added is None:
-            added = added_img
-        else:
-            added = np.flipud(added)
-        data = zlib.compress(struct.pack("<{}I".format(sx*sy), *np.ravel(added.astype(np.uint32, casting='unsafe'))), level=lvl)
-        self.root.edit_block("filterdata/TofCorrection/ImageStack/Reduced Data/ImageStackScansAdded/Image[{}]".format(AN), "ImageArray.Long", data, _type=128)
+        # All the blocks are written at once at the end
+        with BlockWriter(self.root) as w:
+            w.edit_block("filterdata/TofCorrection/ImageStack/Reduced Data/ImageStackScansAdded/Image[{}]".format(AN), "Image.MassIntervalSN", SN.encode('utf8'))
+            w.edit_block("filterdata/TofCorrection/ImageStack/Reduced Data/ImageStackScansAdded/Image[{}]".format(AN), "Image.XSize", struct.pack("<I", sx))
+            w.edit_block("filterdata/TofCorrection/ImageStack/Reduced Data/ImageStackScansAdded/Image[{}]".format(AN), "Image.YSize", struct.pack("<I", sy))
+            if scans is not None:
+                RS = range(self.Nscan)
+                if prog:
+                    RS = PB(RS)
+                for i in RS:
+                    img = np.flipud(scans[i].astype(np.uint32, casting='unsafe'))
+                    data = zlib.compress(struct.pack("<{}I".format(sx*sy), *np.ravel(img)), level=lvl)
+                    w.edit_block("filterdata/TofCorrection/ImageStack/Reduced Data/ImageStackScans/Image[{}]".format(N), "ImageArray.Long", data, id=i, _type=128)
+                    if added is None:
+                        added_img += img
+
+            if added is None:
+                added = added_img
+            else:
+                added = np.flipud(added)
+            data = zlib.compress(struct.pack("<{}I".format(sx*sy), *np.ravel(added.astype(np.uint32, casting='unsafe'))), level=lvl)
+            w.edit_block("filterdata/TofCorrection/ImageStack/Reduced Data/ImageStackScansAdded/Image[{}]".format(AN), "ImageArray.Long", data, _type=128)
         
-        self.root.edit_block("filterdata/TofCorrection/ImageStack/Reduced Data/ImageStackScansAdded/Image[{}]".format(AN), "Image.PulsesPerPixel", struct.pack("<I", self.spp*self.Nscan))
-        self.root.edit_block("filterdata/TofCorrection/ImageStack/Reduced Data/ImageStackScansAdded/Image[{}]".format(AN), "Image.MaxCountsPerPixel", struct.pack("<I", int(np.max(added))))
-        self.root.edit_block("filterdata/TofCorrection/ImageStack/Reduced Data/ImageStackScansAdded/Image[{}]".format(AN), "Image.MinCountsPerPixel", struct.pack("<I", int(np.min(added))))
-        self.root.edit_block("filterdata/TofCorrection/ImageStack/Reduced Data/ImageStackScansAdded/Image[{}]".format(AN), "Image.TotalCountsDbl", struct.pack("<d", np.sum(added)))
-        self.root.edit_block("filterdata/TofCorrection/ImageStack/Reduced Data/ImageStackScansAdded/Image[{}]".format(AN), "Image.TotalCounts", struct.pack("<I", int(np.sum(added))))
+            w.edit_block("filterdata/TofCorrection/ImageStack/Reduced Data/ImageStackScansAdded/Image[{}]".format(AN), "Image.PulsesPerPixel", struct.pack("<I", self.spp*self.Nscan))
+            w.edit_block("filterdata/TofCorrection/ImageStack/Reduced Data/ImageStackScansAdded/Image[{}]".format(AN), "Image.MaxCountsPerPixel", struct.pack("<I", int(np.max(added))))
+            w.edit_block("filterdata/TofCorrection/ImageStack/Reduced Data/ImageStackScansAdded/Image[{}]".format(AN), "Image.MinCountsPerPixel", struct.pack("<I", int(np.min(added))))
+            w.edit_block("filterdata/TofCorrection/ImageStack/Reduced Data/ImageStackScansAdded/Image[{}]".format(AN), "Image.TotalCountsDbl", struct.pack("<d", np.sum(added)))
+            w.edit_block("filterdata/TofCorrection/ImageStack/Reduced Data/ImageStackScansAdded/Image[{}]".format(AN), "Image.TotalCounts", struct.pack("<I", int(np.sum(added))))
         
-        if scans is not None:
-            self.root.edit_block("filterdata/TofCorrection/ImageStack/Reduced Data/ImageStackScans", "Image.NumberOfImages", struct.pack("<I", N+1))
-        self.root.edit_block("filterdata/TofCorrection/ImageStack/Reduced Data/ImageStackScansAdded", "Image.NumberOfImages", struct.pack("<I", AN+1))
+            if scans is not None:
+                w.edit_block("filterdata/TofCorrection/ImageStack/Reduced Data/ImageStackScans", "Image.NumberOfImages", struct.pack("<I", N+1))
+            w.edit_block("filterdata/TofCorrection/ImageStack/Reduced Data/ImageStackScansAdded", "Image.NumberOfImages", struct.pack("<I", AN+1))
         self.Nimg += 1
 
 @aliased
@@ -783,7 +840,7 @@ class ITA_collection(Collection):
     for details on Collection see pySPM.collection.Collection
     """
     def __init__(self, filename, channels1=None, channels2=None, name=None, mass=False, strict
-=False):
+=False, workers=None):
         """
         Opening a ToF-SIMS ITA file as an image collection
 
@@ -800,6 +857,8 @@ class ITA_collection(Collection):
             if True the channel lists are in mass and not names
         strict : bool
             Is the channel name strict? (see pySPM.ITA.getChannelsByName)
+        workers : None or int
+            The number of threads decompressing the images (see pySPM.ITA.get_image_cube)
 
         Returns
         -------
@@ -825,10 +884,20 @@ class ITA_collection(Collection):
             if channels is channels2:
                 strict = False
             if type(channels) is list:
-                for x in channels:
-                    if mass:
+                if mass:
+                    # All the images are loaded at once
+                    ids = []
+                    for x in channels:
+                        try:
+                            ids.append((x, self.ita.get_channel_by_mass(x)))
+                        except:
+                            pass
+                    cube = self.ita.get_added_image_cube([ch for x, ch in ids], workers=workers)
+                    all_masses = self.ita.get_masses()
+                    for (x, ch), Z in zip(ids, cube):
                         try:
-                            I = self.ita.get_added_image_by_mass(x)
+                            m = all_masses[ch]
+                            I = self.ita.image(np.flipud(Z.astype(np.float64)), channel=[m['assign'], "{cmass:.2f}u".format(**m)][m['assign'] == ''])
                             m = masses[2+channels1.index(x)]
                             if m['assign'] != '':
                                 self.add(I, m['assign'])
@@ -836,7 +905,8 @@ class ITA_collection(Collection):
                                 self.add(I, "{cmass:.2f}u".format(cmass=x))
                         except:
                             pass
-                    else:
+                else:
+                    for x in channels:
                         Z, ch = self.ita.get_added_image_by_name(x, strict)
                         self.msg += "{0}\n".format(x)
                         for z in ch:
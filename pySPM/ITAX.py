@@ -26,9 +26,7 @@ class ITAX:
                     blk = Block(self.f)
                     sx = blk.goto('res_x').getLong()
                     sy = blk.goto('res_y').getLong()
-                    raw = blk.goto("imagedata").value
-                    data = zlib.decompress(raw)
-                    I = np.flipud(np.array(struct.unpack("<"+str(3*sx*sy)+"B", data)).reshape((sy, sx, 3)))
+                    I = np.flipud(blk.goto("imagedata").get_array('B', (sy, sx, 3))).copy()
                     snapshots.append(I)
                     del blk
         return snapshots
@@ -53,8 +51,7 @@ class ITAX:
         Retrieve the spectrum in a similar way as for ITA file
         """
         slen = self.root.goto("CommonDataObjects/DataViewCollection/*/sizeSpectrum").getLong()
-        raw = self.root.goto("CommonDataObjects/DataViewCollection/*/dataSource/simsDataCache/spectrum/correctedData").value
-        spectrum = np.array(struct.unpack("<"+str(slen)+"d", raw))
+        spectrum = self.root.goto("CommonDataObjects/DataViewCollection/*/dataSource/simsDataCache/spectrum/correctedData").get_array('d', decompress=False)[:slen].copy()
         CH = 2*np.arange(slen)        
         if time:
             return CH, spectrum
@@ -83,11 +83,7 @@ class SlicerApp(QWidget):
     def load_channel(self, row, col):
         self.ui.status.setText("Loading channel...")
         id = row
-        vol = []
-        for i in range(self.ITA.Nscan):
-            x = self.ITA.getImage(id, i)
-            vol.append(x)
-        self.volume = np.stack([x for x in vol], axis=2)
+        self.volume = np.moveaxis(self.ITA.get_image_cube(id)[0], 0, 2).astype(np.float64)
         if not self.level is None:
             self.corrected = np.zeros(self.volume.shape)
             z = np.arange(self.ITA.Nscan)
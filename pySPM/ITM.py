@@ -11,6 +11,7 @@ import zlib
 import re
 import os
 from .utils.misc import deprecated, aliased, alias, PB
+from .utils.cache import cached
 from warnings import warn
 
 class InvalidRAWdataformat(Exception):
@@ -21,9 +22,461 @@ class InvalidRAWdataformat(Exception):
     def __str__(self):
         return "Invalid RAW dataformat seen in block "+self.block.path+self.block.name+' : '+self.msg
 
+def decode_raw_data(raw, pixels=False):
+    """
+    Decode the raw data of a scan (i.e. the decompressed content of its '  14' blocks) into columnar arrays.
+
+    The raw data are a suite of uint32. Each pixel starts with a header of three uint32 having at least one of their
+    two most significant bits set (x, y and pixel id) followed by the events (channel number) of that pixel.
+    Pixels without any events produce consecutive headers.
+
+    Parameters
+    ----------
+    raw : bytes
+        The raw data as returned by pySPM.ITM.get_raw_raw_data
+    pixels : bool
+        If True, the pixel headers are returned as well
+
+    Returns
+    -------
+    dict
+        Dictionary of 1D numpy arrays with one element per event:
+            - x, y : coordinates of the pixel where the event was recorded
+            - id : pixel id
+            - channel : the time of flight (in channel unit)
+    dict
+        Only returned if pixels is True. Dictionary of 1D numpy arrays with one element per pixel header:
+        x, y, id and count (the number of events recorded for that pixel)
+    """
+    rawv = np.frombuffer(raw, dtype='<u4', count=len(raw)//4)
+    res, pix, _ = _decode_raw_words(rawv)
+    if pixels:
+        return res, pix
+    return res
+
+def _decode_raw_words(rawv):
+    """
+    Decode a suite of raw uint32 (see decode_raw_data).
+    Return the events, the pixel headers and the positions of the pixel headers in rawv.
+    """
+    flag = (rawv & 0xc0000000) != 0
+    pos = np.arange(len(rawv))
+    # Start position of each run of consecutive flagged uint32. Headers are grouped by three within each run.
+    first = flag.copy()
+    first[1:] &= ~flag[:-1]
+    run_start = np.maximum.accumulate(np.where(first, pos, 0))
+    header = flag & ((pos-run_start)%3 == 0)
+    header[len(rawv)-2:] = False # incomplete header
+    starts = np.nonzero(header)[0]
+    pix = np.cumsum(header)-1 # index of the last seen pixel header for each uint32
+    events = np.nonzero(~flag & (pix >= 0))[0]
+    pix = pix[events]
+    x = rawv[starts] & 0x0fffffff
+    y = rawv[starts+1] & 0x0fffffff
+    ids = rawv[starts+2] & 0x3fffffff
+    res = dict(x=x[pix], y=y[pix], id=ids[pix], channel=rawv[events])
+    return res, dict(x=x, y=y, id=ids, count=np.bincount(pix, minlength=len(starts))), starts
+
+class _RawEventStream:
+    """
+    Incremental decoder of the raw data. The raw data can be fed by pieces of arbitrary size.
+    """
+    def __init__(self):
+        self.carry = np.zeros(0, dtype='<u4')
+        self.rest = b''
+
+    def feed(self, data):
+        """
+        Decode a new piece of raw data and return its events (see decode_raw_data)
+        """
+        data = self.rest+data
+        n = 4*(len(data)//4)
+        self.rest = data[n:]
+        rawv = np.concatenate((self.carry, np.frombuffer(data, dtype='<u4', count=n//4)))
+        res, _, starts = _decode_raw_words(rawv)
+        # Keep the words needed to decode the next piece: the last pixel header (which applies to the events
+        # at the beginning of the next piece) or the incomplete header at the end of the piece.
+        flag = (rawv & 0xc0000000) != 0
+        if len(rawv) and flag[-1]:
+            events = np.nonzero(~flag)[0]
+            run = len(rawv)-(events[-1]+1 if len(events) else 0)
+            self.carry = rawv[len(rawv)-(run%3 or 3):].copy()
+        elif len(starts):
+            self.carry = rawv[starts[-1]:starts[-1]+3].copy()
+        return res
+
+def _iter_raw_events(f, offsets, chunk_bytes=2**24):
+    """
+    Decompress incrementally the '  14' blocks at the given offsets (in order to keep a bounded memory usage)
+    and yield the decoded events of each decompressed piece of at most chunk_bytes.
+    """
+    stream = _RawEventStream()
+    for offset in offsets:
+        data = Block.Block(f, offset=offset).value
+        d = zlib.decompressobj()
+        while data:
+            yield stream.feed(d.decompress(data, chunk_bytes))
+            data = d.unconsumed_tail
+        yield stream.feed(d.flush())
+
+def _concat_events(batch):
+    return {k: np.concatenate([ev[k] for ev in batch]) for k in batch[0]}
+
+def _read_raw(f, offsets):
+    """
+    Read and decompress the '  14' blocks located at the given offsets.
+    """
+    return b''.join(Block.prefetch(f, offsets, cache=False))
+
+def _accumulate(out, index, weights=None):
+    """
+    Add the weights (1 if None) of the events to the flat index of out in place.
+    Only the occupied indices are counted, so that the temporary arrays scale with the number of events and not with the size of out.
+    """
+    if len(index) == 0:
+        return out
+    occupied, inverse = np.unique(index, return_inverse=True)
+    flat = out.reshape(-1)
+    flat[occupied] += np.bincount(inverse.ravel(), weights=weights, minlength=len(occupied)).astype(out.dtype, copy=False)
+    return out
+
+def _reduce_scans(scan_events, func, kargs, reduce=True):
+    """
+    Apply func to each batch of events of several scans and sum the results of each scan.
+    scan_events is an iterable giving for each scan an iterable of event batches (see pySPM.ITM.decode_raw_data).
+    func(ev, out=None, **kargs) returns a new result if out is None and adds the result to out in place otherwise,
+    so that a single accumulator is built for all the scans (or for each scan if reduce is False).
+    Return the sum of the results if reduce is True or the list of the results of each scan otherwise.
+    """
+    res = None
+    results = []
+    for batches in scan_events:
+        r = res if reduce else None
+        for ev in batches:
+            if len(ev['channel']) == 0:
+                continue
+            r = func(ev, out=r, **kargs)
+        if r is None:
+            r = func(decode_raw_data(b''), **kargs)
+        if reduce:
+            res = r
+        else:
+            results.append(r)
+    return res if reduce else results
+
+def _process_scans(f, scan_offsets, func, kargs, reduce=True, chunk_events=2**22):
+    """
+    Apply func to the decoded events of several scans given by the offsets of their '  14' blocks.
+    The events are streamed by pieces of at most chunk_events and the results of func are summed for each scan.
+    Return the sum of the results if reduce is True or the list of the results of each scan otherwise.
+    """
+    return _reduce_scans((_iter_raw_events(f, offsets, 4*chunk_events) for offsets in scan_offsets), func, kargs, reduce)
+
+def _raw_worker(filename, scan_offsets, func, kargs, reduce=True, chunk_events=2**22):
+    """
+    Worker function of the process pool used by pySPM.ITM._map_scans. Each worker opens its own file handle.
+    """
+    with open(filename, 'rb') as f:
+        return _process_scans(f, scan_offsets, func, kargs, reduce, chunk_events)
+
+def _events_worker(path, scans, func, kargs, reduce=True, chunk_events=2**22):
+    """
+    Worker function of the process pool used by pySPM.ITM._map_scans when the events were exported (see pySPM.ITMEvents)
+    """
+    events = ITMEvents(path)
+    return _reduce_scans((events.iter_scan(s, chunk_events) for s in scans), func, kargs, reduce)
+
+def _fov_time(ev, dts):
+    """
+    Time of flight (in channel unit) of the decoded events corrected for the primary ion time of flight (see pySPM.ITM._get_time_shift)
+    """
+    return ev['channel']-dts[ev['x']]
+
+def _fov_split(ev, dts=None):
+    """
+    FOV correction stage shared by all the raw data consumers.
+    The corrected time of each event falls between the channels floor(t) and floor(t)+1
+    and the event is split between them with the weights 1-frac(t) and frac(t).
+
+    Parameters
+    ----------
+    ev : dict
+        The decoded events (see pySPM.ITM.decode_raw_data)
+    dts : None or array
+        The time correction for each x coordinate (in channel unit). If None no correction is applied.
+
+    Returns
+    -------
+    t : int array
+        The channel of each entry
+    w : float array or None
+        The weight of each entry (None if no correction is applied, i.e. all the weights are 1)
+    i : int array or slice
+        The index of the event of each entry, in order to select the other columns of the events (e.g. ev['x'][i])
+    """
+    if dts is None:
+        return ev['channel'].astype(np.int64), None, slice(None)
+    tc = _fov_time(ev, dts)
+    t = np.floor(tc)
+    frac = tc-t
+    t = t.astype(np.int64)
+    idx = np.arange(len(t))
+    t, w, i = np.concatenate((t, t+1)), np.concatenate((1-frac, frac)), np.concatenate((idx, idx))
+    keep = w > 0
+    return t[keep], w[keep], i[keep]
+
+def _binning(binning):
+    """
+    Normalize a spatial binning given as an int b (for b x b pixels) or as (bx, by)
+    """
+    if hasattr(binning, '__iter__'):
+        bx, by = binning
+        return int(bx), int(by)
+    return int(binning), int(binning)
+
+def _binned_shape(shape, binning):
+    """
+    Shape (height, width) of an image of the given shape once binned by (bx, by) pixels (the last incomplete bins are kept)
+    """
+    bx, by = _binning(binning)
+    return ((shape[0]+by-1)//by, (shape[1]+bx-1)//bx)
+
+def _scan_groups(scans, bin_z=1):
+    """
+    Scan binning stage: split the list of scans into groups of bin_z consecutive scans (the last one can be smaller)
+    """
+    scans = list(scans)
+    return [scans[i:i+bin_z] for i in range(0, len(scans), bin_z)]
+
+def _bin_pixels(ev, binning, width, i=slice(None)):
+    """
+    Spatial binning stage shared by the raw data reducers.
+    Return the index (y//by)*width+x//bx of the binned pixel of each event (selected by i, see _fov_split),
+    width being the width of the binned image (see _binned_shape).
+    """
+    bx, by = _binning(binning)
+    x, y = ev['x'], ev['y']
+    if bx > 1:
+        x = x//bx
+    if by > 1:
+        y = y//by
+    return (y.astype(np.int64)*width+x)[i]
+
+def _roi_lookup(ROI):
+    """
+    Build the lookup table giving the ROIs of each pixel (see pySPM.ITM.get_raw_spectrum) in a compressed (CSR) form.
+    ROI is either an image of integer labels or a list (or 3D array) of boolean masks which can overlap.
+    Return (ptr, labels, number of ROIs, image width) where the ROIs of the pixel p are labels[ptr[p]:ptr[p+1]]
+    """
+    if type(ROI) is np.ndarray and ROI.ndim == 2:
+        labels = ROI.ravel().astype(np.int64)
+        return np.arange(labels.size+1), labels, int(np.max(ROI))+1, ROI.shape[1]
+    masks = np.array([np.asarray(R, dtype=bool) for R in ROI])
+    pix, labels = np.nonzero(masks.reshape((len(masks), -1)).T) # sorted by pixel
+    ptr = np.concatenate(([0], np.cumsum(np.bincount(pix, minlength=masks[0].size))))
+    return ptr, labels, len(masks), masks.shape[2]
+
+def _raw_spectrum(ev, dts, number_channels, roi=None, binning=1, out=None):
+    """
+    Spectrum (or spectra per ROI) of the decoded events of a scan (see pySPM.ITM.get_raw_spectrum)
+    roi is the ROI lookup table given by pySPM.ITM._roi_lookup, defined on the image binned by binning (see _bin_pixels)
+    Return (or add to out) a float32 array of shape (number of channels, number of ROIs)
+    """
+    t, w, i = _fov_split(ev, dts)
+    if roi is None:
+        nroi = 1
+        lab = np.zeros(len(t), dtype=np.int64)
+    else:
+        ptr, labels, nroi, width = roi
+        pix = _bin_pixels(ev, binning, width, i)
+        start = ptr[pix]
+        n = ptr[pix+1]-start
+        # Each entry is repeated once for each ROI containing its pixel (the ROIs can overlap)
+        rep = np.repeat(np.arange(len(t)), n)
+        pos = np.arange(len(rep))-np.repeat(np.cumsum(n)-n, n)+np.repeat(start, n)
+        lab = labels[pos]
+        t = t[rep]
+        if w is not None:
+            w = w[rep]
+    if out is None:
+        out = np.zeros((number_channels, nroi), dtype=np.float32)
+    mask = (t >= 0)*(t < number_channels)
+    return _accumulate(out, t[mask]*nroi+lab[mask], None if w is None else w[mask])
+
+def _raw_total_spectrum(ev, dts, channels, out=None):
+    """
+    Total spectrum of the decoded events of a scan (see pySPM.ITM.spectra_per_pixel)
+    """
+    if out is None:
+        out = np.zeros(channels)
+    t, w, _ = _fov_split(ev, dts)
+    mask = (t >= 0)*(t < channels)
+    return _accumulate(out, t[mask], None if w is None else w[mask])
+
+def _raw_spectra_per_pixel(ev, dts, rev, tx, binning, width, size, sparse=False, out=None):
+    """
+    Spectra per aggregated pixel of the decoded events of a scan (see pySPM.ITM.spectra_per_pixel)
+    If sparse is True a scipy.sparse CSR matrix is returned instead of a dense float32 array.
+    """
+    t, w, i = _fov_split(ev, dts)
+    mask = (t >= 0)*(t < rev.size)
+    t = t[mask]
+    j1 = rev[t]
+    # events falling outside the selected peaks are attributed to the closest selected time
+    missing = j1<0
+    if np.any(missing):
+        tm = t[missing]
+        right = np.minimum(np.searchsorted(tx, tm), tx.size-1)
+        left = np.maximum(right-1, 0)
+        j1[missing] = np.where(np.abs(tm-tx[left]) <= np.abs(tx[right]-tm), left, right)
+    k = _bin_pixels(ev, binning, width, i)[mask]
+    if sparse:
+        from scipy.sparse import coo_matrix
+        w = np.ones(len(k), dtype=np.float32) if w is None else w[mask].astype(np.float32)
+        res = coo_matrix((w, (k, j1)), shape=size).tocsr() # the duplicates are summed
+        return res if out is None else out+res
+    if out is None:
+        out = np.zeros(size, dtype=np.float32)
+    return _accumulate(out, k*tx.size+j1, None if w is None else w[mask])
+
+def _window_layers(left, right):
+    """
+    Split a list of (integer) windows [left, right] into groups of non-overlapping windows.
+    Return a list of lists of window indices sorted by their left boundary.
+    """
+    layers = []
+    ends = []
+    for i in np.argsort(left, kind='stable'):
+        if left[i] > right[i]:
+            continue # empty window
+        j = 0
+        while j < len(layers) and ends[j] >= left[i]:
+            j += 1
+        if j == len(layers):
+            layers.append([])
+            ends.append(None)
+        layers[j].append(i)
+        ends[j] = right[i]
+    return layers
+
+def _window_hits(t, left, right):
+    """
+    Find the integer times t falling in the [left, right] windows (which can overlap).
+    Yield for each group of non-overlapping windows (see _window_layers) the mask of the times inside one of them
+    and the index of their window.
+    """
+    # The times are integers, so the windows can be expressed as [ceil(left), floor(right)+1[
+    L = np.ceil(left).astype(np.int64)
+    R = np.floor(right).astype(np.int64)
+    for layer in _window_layers(L, R):
+        edges = np.ravel(np.column_stack((L[layer], R[layer]+1)))
+        k = np.searchsorted(edges, t, side='right')
+        inside = k%2 == 1 # an odd number of edges below t means that t is inside a window
+        yield inside, np.array(layer)[k[inside]//2]
+
+def _raw_images(ev, left, right, shape, dts=None, binning=1, out=None):
+    """
+    Count the events of a scan falling in each [left, right] window for each pixel (see pySPM.ITM.reconstruct).
+    If dts is given, the times are corrected for the primary ion time of flight (see pySPM.ITM._fov_split).
+    The pixels are binned by binning (see _bin_pixels) and shape is the binned shape.
+    Return an array of shape (number of windows, height, width)
+    """
+    n = len(left)
+    npix = shape[0]*shape[1]
+    t, w, i = _fov_split(ev, dts)
+    pix = _bin_pixels(ev, binning, shape[1], i)
+    if out is None:
+        out = np.zeros((n,)+shape)
+    for inside, win in _window_hits(t, left, right):
+        _accumulate(out, win*npix+pix[inside], None if w is None else w[inside])
+    return out
+
+def _raw_profile(ev, left, right, dts=None, channels=0, out=None):
+    """
+    Count the events of a scan falling in each [left, right] window (see pySPM.ITM.get_raw_profile).
+    If channels is larger than 0, the spectrum of the scan (with that number of channels) is appended to the counts.
+    """
+    n = len(left)
+    t, w, _ = _fov_split(ev, dts)
+    if out is None:
+        out = np.zeros(n+channels)
+    for inside, win in _window_hits(t, left, right):
+        out[:n] += np.bincount(win, weights=None if w is None else w[inside], minlength=n)
+    if channels > 0:
+        mask = (t >= 0)*(t < channels)
+        _accumulate(out[n:], t[mask], None if w is None else w[mask])
+    return out
+
+class ITMEvents:
+    """
+    Reader of the raw events exported by pySPM.ITM.export_events.
+    The events are stored as uncompressed .npy shards (one file per column and per chunk of each scan)
+    which are memory-mapped, so that the data are read directly from the disk cache without any decoding.
+    """
+    columns = ['x', 'y', 'id', 'channel']
+    dtypes = {'time': np.float32} # the other columns are uint32
+
+    def __init__(self, path):
+        """
+        Parameters
+        ----------
+        path : string
+            The directory where the events were exported
+        """
+        self.path = path
+        with np.load(os.path.join(path, 'meta.npz')) as meta:
+            self.filename = str(meta['filename'])
+            self.stat = meta['stat'].tolist()
+            self.shards = meta['shards'] # rows of (scan, number of events)
+            self.columns = meta['columns'].tolist()
+            self.size = dict(x=int(meta['size'][0]), y=int(meta['size'][1]))
+            self.Nscan = int(meta['Nscan'])
+
+    def __len__(self):
+        return int(np.sum(self.shards[:, 1]))
+
+    def get_scans(self):
+        """
+        Return the list of the exported scans
+        """
+        return np.unique(self.shards[:, 0]).tolist()
+
+    def _load(self, i):
+        return {k: np.load(os.path.join(self.path, '{}_{:05d}.npy'.format(k, i)), mmap_mode='r') for k in self.columns}
+
+    def iter_scan(self, scan, chunk_events=None):
+        """
+        Iterate over the memory-mapped event batches of a given scan.
+        If chunk_events is given, the shards are split into batches of at most chunk_events.
+        """
+        for i in np.nonzero(self.shards[:, 0] == scan)[0]:
+            ev = self._load(i)
+            n = int(self.shards[i, 1])
+            step = n if not chunk_events else chunk_events
+            for j in range(0, n, step):
+                yield {k: ev[k][j:j+step] for k in ev}
+
+    def iter_events(self, scans=None, chunk_events=None):
+        """
+        Iterate over the events of the given scans (all exported scans if None).
+        Each batch is a dictionary of memory-mapped arrays with the keys scan, x, y, id, channel (and time if exported).
+        """
+        if scans is None:
+            scans = self.get_scans()
+        for s in scans:
+            for ev in self.iter_scan(s, chunk_events):
+                ev['scan'] = np.full(len(ev['channel']), s, dtype=np.uint32)
+                yield ev
+
+    def get_column(self, name, scans=None):
+        """
+        Return the concatenation of a column for the given scans (all exported scans if None).
+        """
+        return np.concatenate([ev[name] for ev in self.iter_events(scans)]+[np.zeros(0, dtype=self.dtypes.get(name, np.uint32))])
+
 @aliased
 class ITM:
-    def __init__(self, filename, debug=False, readonly=True, precond=False, label=None):
+    def __init__(self, filename, debug=False, readonly=True, precond=False, label=None, mmap=False, index=False, block_cache=2**26, cache=False):
         """
         Create the ITM object out of the filename.  Note that this works for
         all .ITA,.ITM, .ITS files as they have the same structure
@@ -64,8 +517,21 @@ class ITM:
             This might be also useful in case the file is open by another program which locks the file.
         precond : bool
             If True will run the preconditioner (adjust k0 so that H peak is correct and adjust scaling factor on the H peak)
+        mmap : bool
+            If True the file is memory-mapped (only in readonly mode). The blocks values are then only loaded when accessed,
+            which speeds up the navigation in the file (see pySPM.Block.open_mmap).
+        index : bool
+            If True the table of contents of the file is built in one sequential pass (or loaded from its sidecar file)
+            and all the subsequent navigation is served from it (see pySPM.ITM.get_toc)
+        block_cache : int
+            Byte budget of the LRU cache of the decompressed blocks (spectra, images, ...) shared by all the Blocks of the file.
+            Use 0 to disable it (see pySPM.Block.DecompressCache and pySPM.ITM.get_block_cache_stats)
+        cache : bool or string
+            If True (or the path of a directory) the results of the expensive methods (get_raw_spectrum, spectra_per_pixel, ...)
+            are cached on the disk and reused as long as the file is not modified (see pySPM.utils.cache)
         """
         self.filename = filename
+        self.cache = cache
         if label is None:
             self.label = os.path.basename(filename)
         else:
@@ -73,13 +539,20 @@ class ITM:
         if not os.path.exists(filename):
             print("ERROR: File \"{}\" not found".format(filename))
             raise FileNotFoundError
+        if mmap and not readonly:
+            raise ValueError("Memory-mapping is only available in readonly mode")
         if readonly:
             self.f = open(self.filename, 'rb')
         else:
             self.f = open(self.filename, 'r+b')
+        if mmap:
+            Block.open_mmap(self.f)
+        Block.set_decompress_cache(self.f, block_cache)
         self.Type = self.f.read(8)
         assert self.Type == b'ITStrF01'
         self.root = Block.Block(self.f)
+        if index:
+            self.get_toc(save=True)
         try:
             d = self.root.goto('Meta/SI Image').dict_list()
             self.size = {
@@ -104,6 +577,8 @@ class ITM:
         self.peaks = {}
         self.meas_data = {}
         self.rawlist = None
+        self.rawindex = None
+        self.events = None
         try:
             self.Nscan = self.root.goto("filterdata/TofCorrection/ImageStack/Reduced Data/NumberOfScans").getLong()
         except:
@@ -158,8 +633,7 @@ class ITM:
         for x in self.root.goto("PropertyTrends"):
             if (x.name=='PropertyTrend' and x.goto("Trend.Name").get_string() == name) or x.name == name:
                 N = x.goto('Trend.Data.NumberEntries').get_long()
-                data = x.goto("Trend.Data").value
-                dat = np.array([struct.unpack('<4d',data[32*i:32*(i+1)])[2:4] for i in range(N)])
+                dat = x.goto("Trend.Data").get_array('d', decompress=False)[:4*N].reshape((N, 4))[:, 2:4].copy()
                 return dat
         return None
         
@@ -335,7 +809,7 @@ class ITM:
         Retrieve the total Ion image
         """
         X, Y = self.size['pixels']['x'], self.size['pixels']['y']
-        img = self.image(np.flipud(np.array(self.root.goto('Meta/SI Image/intensdata').get_data("f"), dtype=np.float32).reshape((Y, X))), channel="SI count")
+        img = self.image(np.flipud(self.root.goto('Meta/SI Image/intensdata').get_array("f", (Y, X)).copy()), channel="SI count")
         return img
 
     def get_LMIG_info(self):
@@ -405,8 +879,33 @@ class ITM:
             fitting_peaks = fitting_peaks.split(",")
         negative = self.polarity=='Negative'
         fitting_peaks = [x+[['+','-'][negative],'']['+' in x or '-' in x] for x in fitting_peaks]
+        if not 'sf' in kargs:
+            sf = self.sf
+        else:
+            sf = kargs.pop('sf')
+        if not 'k0' in kargs:
+            k0 = self.k0
+        else:
+            k0 = kargs.pop('k0')
+        sf, k0, dsf, dk0, ts, ms = self._fit_mass_cal(t, S, fitting_peaks, Range, sf, k0)
+        if apply:
+            self.set_sf(sf)
+            self.set_k0(k0)
+        self.sf = sf
+        self.k0 = k0
+        if debug:
+            return sf, k0, dsf, dk0, ts, ms
+        if error:
+            return sf, k0, dsf, dk0
+        return sf, k0
+
+    @cached
+    def _fit_mass_cal(self, t, S, fitting_peaks, Range, sf, k0):
+        """
+        Mass calibration fit of pySPM.ITM.auto_mass_cal (without side effects, so that its result can be cached).
+        Return sf, k0, dsf, dk0, ts, ms
+        """
         from .utils import get_mass, time2mass, fit_spectrum, mass2time
-        from scipy.optimize import curve_fit
         time_width = 1e10*self.root.goto('propend/Instrument.LMIG.Chopper.Width').get_key_value()['float']
         if t is None or S is None:
             t, S = self.get_spectrum(time=True)
@@ -418,15 +917,6 @@ class ITM:
         tH = times[0]
         mask = (t>=tH-time_width)*(t<=tH+time_width)
         tH = t[mask][np.argmax(S[mask])]
-        if not 'sf' in kargs:
-            sf = self.sf
-        else:
-            sf = kargs.pop('sf')
-        if not 'k0' in kargs:
-            k0 = self.k0
-        else:
-            k0 = kargs.pop('k0')
-            
         if sf is None or k0 is None:
             sf = 72000
             for i in range(3):
@@ -444,16 +934,7 @@ class ITM:
             ts.append(t_peak)
         ms = [get_mass(x) for x in fitting_peaks]
         sf, k0, dsf, dk0 = fit_spectrum(ts, ms, error=True)
-        if apply:
-            self.set_sf(sf)
-            self.set_k0(k0)
-        self.sf = sf
-        self.k0 = k0
-        if debug:
-            return sf, k0, dsf, dk0, ts, ms
-        if error:
-            return sf, k0, dsf, dk0
-        return sf, k0
+        return sf, k0, dsf, dk0, ts, ms
     
     @alias("showValues")
     def show_values(self, pb=False, gui=False, **kargs):
@@ -596,11 +1077,11 @@ class ITM:
         This only works for .ita and .its files.
         For this reason it is implemented in the itm class.
         """
-        RAW = zlib.decompress(self.root.goto(
-            'filterdata/TofCorrection/Spectrum/Reduced Data/IITFSpecArray/'+['CorrectedData','Data'][kargs.get('uncorrected',False)]).value)
+        RAW = self.root.goto(
+            'filterdata/TofCorrection/Spectrum/Reduced Data/IITFSpecArray/'+['CorrectedData','Data'][kargs.get('uncorrected',False)]).get_array('f')
         if scale is None:
             scale = self.scale
-        D = scale*np.array(struct.unpack("<{0}f".format(len(RAW)//4), RAW))
+        D = scale*RAW.astype(np.float64)
         ch = 2*np.arange(len(D)) # We multiply by two because the channels are binned.
         if time:
             return ch, D
@@ -619,12 +1100,22 @@ class ITM:
         """
         if name in self.meas_data:
             return self.meas_data[name]
-        self.rawdata = self.root.goto('rawdata')
-        L = self.rawdata.get_list()
-        i = 1
-        while L[-i]['name'] !=  '  20':
-            i += 1
-        max_index = L[-i]['id']
+        for key, values in self._read_meas_data(prog=prog).items():
+            if not key in self.meas_data:
+                self.meas_data[key] = values
+        if name in self.meas_data:
+            return self.meas_data[name]
+        else:
+            raise KeyError(name)
+
+    @cached
+    def _read_meas_data(self, prog=False):
+        """
+        Read all the parameters saved during the measurement (the '  20' blocks of the rawdata).
+        Return a dictionary {name: [(block offset, value), ...]}
+        """
+        meas_data = {}
+        L = self.root.goto('rawdata').get_list()
         if prog:
             T = PB(L)
         else:
@@ -633,16 +1124,12 @@ class ITM:
             if elt['name'] != '  20':
                 continue
             idx = elt['bidx']
-            self.f.seek(idx)
-            child = Block.Block(self.f)
+            child = Block.Block(self.f, offset=idx)
             r = child.get_key_value(0)
-            if not r['key'] in self.meas_data:
-                self.meas_data[r['key']] = []
-            self.meas_data[r['key']].append((idx, r['float']))
-        if name in self.meas_data:
-            return self.meas_data[name]
-        else:
-            raise KeyError(name)
+            if not r['key'] in meas_data:
+                meas_data[r['key']] = []
+            meas_data[r['key']].append((idx, r['float']))
+        return meas_data
     
     def show_stability(self, ax=None, prog=False):
         from .utils.plot import dual_plot
@@ -717,41 +1204,29 @@ class ITM:
         return utils.show_peak(m, D*amp_scale, m0, delta, polarity=polarity, sf=sf, k0=k0, **kargs)
         
     @deprecated("SpectraPerPixel")
-    def spectra_per_pixel(self, pixel_aggregation=None, peak_lim=0, scans=None, prog=False, safe=True, FOVcorr=True, smooth=False):
+    @cached
+    def spectra_per_pixel(self, pixel_aggregation=None, peak_lim=0, scans=None, prog=False, safe=True, FOVcorr=True, smooth=False, workers=None, sparse=False):
         """
         This function return a 2D array representing the spectra per pixel. The first axis correspond to each aggregated pixel and the second axis the spectral time.
         In order to keep the 2D array small enough the spectra are filtered in order to keep only strictly positive values (or larger than peak_lim).
         
         Parameters
         ----------
-        pixel_aggregation: int
-            the number of pixels aggregation. pixel_aggregation 
+        pixel_aggregation: int or (int, int)
+            the number of pixels aggregation, either b for b x b pixels or (bx, by)
+        workers: None or int
+            If larger than 1, the scans are processed in parallel by a pool of workers processes
+        sparse: bool
+            If True the spectra are returned as a scipy.sparse CSR matrix (only the non-zero values are stored),
+            so that the spectra of all the pixels can be kept at full resolution (e.g. pixel_aggregation=1)
+            and fed directly to sparse decompositions. The RAM check (safe) is then skipped and smooth is not available.
         
         """
+        if sparse and smooth:
+            raise ValueError("The spectra cannot be smoothed in sparse mode")
         if pixel_aggregation is None:
             pixel_aggregation = max(1, int(self.size['pixels']['x']//64))
                  
-        from .utils import get_mass, constants as const, closest_arg
-        gun = self.root.goto('propend/Instrument.PrimaryGun.Species').get_key_value()['string'] # Primary Gun Species (Bi1,Bi3,Bi3++)
-        
-        # if the + is missing in the name, add it
-        if gun[-1]!='+':
-            gun += '+'
-            
-        Q = gun.count('+') # number of charge
-        
-        nrj = self.root.goto('propend/Instrument.PrimaryGun.Energy').get_key_value()['float'] # Primary ion energy (in eV)
-        dx = self.size['real']['x']/self.size['pixels']['x'] # distance per pixel
-        
-        # Calculate the mass of the primary ion
-        mp = get_mass(gun)
-        
-        if FOVcorr:
-            DT = dx*(1/5e-11)*.5*np.sqrt(2)*np.sqrt((1e-3*mp/const.NA)/(Q*2*nrj*const.qe)) # delta time in channel per pixel. The 5e-11 is the channelwidth (50ps)
-            # sqrt(2)/2 is from the sin(45°), nrj=E=.5*mp*v^2
-        else:
-            DT = 0
-            
         if peak_lim is None:
             peak_lim = 0
             
@@ -761,7 +1236,8 @@ class ITM:
         else:
             IT = lambda x: x
             
-        pixel_size = ((self.size['pixels']['x']+pixel_aggregation-1)//pixel_aggregation)*((self.size['pixels']['y']+pixel_aggregation-1)//pixel_aggregation)
+        shape = _binned_shape((self.size['pixels']['y'], self.size['pixels']['x']), pixel_aggregation)
+        pixel_size = shape[0]*shape[1]
         channels = round(self.get_value("Measurement.CycleTime")['float']/self.get_value("Registration.TimeResolution")['float'])
         
         # calculate total spectra
@@ -769,23 +1245,8 @@ class ITM:
         
         if scans is None:
             scans = range(self.Nscan)
-        dts = DT*(self.size['pixels']['x']/2-np.arange(self.size['pixels']['x'])) # time correction for the given x coordinate (in channel number)
-        for scan in IT(scans):
-            raw = self.get_raw_raw_data(scan)
-            rawv = struct.unpack('<{}I'.format(len(raw)//4), raw)
-            i = 0
-            while i<len(rawv):
-                b = rawv[i]
-                if b& 0xc0000000:
-                    x = b & 0x0fffffff
-                    dt = dts[x]
-                    #fp = dt%1
-                    ip = int(dt)
-                    i += 3
-                else:
-                    m[b-ip] += 1#(1-fp)
-                    #m[b-ip-1] += fp
-                    i += 1
+        dts = self._get_time_shift() if FOVcorr else None # time correction for the given x coordinate (in channel number)
+        m += self._map_scans(_raw_total_spectrum, scans, workers=workers, prog=prog, dts=dts, channels=channels)
                     
         # calculate the extreme cases
         max_time = np.nonzero(m)[0][-1]
@@ -799,48 +1260,28 @@ class ITM:
         t = np.arange(channels)
         tx = t[m>peak_lim] # reduced time vector
         mx = m[m>peak_lim] # reduced mass vector
-        rev = {x:-1 for x in range(max_time+1)}
-        for k in range(len(tx)):
-            rev[tx[k]] = k
+        rev = -np.ones(max_time+1, dtype=int)
+        rev[tx] = np.arange(len(tx))
         
-        if safe:
+        if safe and not sparse:
             import psutil
             free_ram = psutil.virtual_memory().free
-            if pixel_size*tx.size*4>= free_ram:
+            # A single float32 accumulator is used, but with workers each process has its own (plus a copy to send it back)
+            # and two of them are held by the main process while they are summed
+            copies = 1 if not workers or workers <= 1 else 2*workers+2
+            if pixel_size*tx.size*4*copies >= free_ram:
                 raise Exception("""You don't have sufficient free RAM to perform this operation.
                 Free RAM: {ram:.1f}Mb
                 Number of pixels: {Npix}
                 Spectrum size [value>{peak_lim}] : {tx} elements
-                Array size: {N} elements = {ss}Mb
+                Array size: {N} elements = {ss}Mb ({copies} copies)
                 It is advised that you clean up memory or use a higher pixel_aggregation value.
                 You can force the execution of this command by using the argument safe=False.
-                """.format(ram=free_ram/1024**2, peak_lim=peak_lim, Npix=pixel_size, tx=tx.size, N=pixel_size*tx.size, ss=pixel_size*tx.size*4/1024**2))
+                """.format(ram=free_ram/1024**2, peak_lim=peak_lim, Npix=pixel_size, tx=tx.size, N=pixel_size*tx.size, ss=pixel_size*tx.size*4/1024**2, copies=copies))
                 
         size = (pixel_size, tx.size)
-        spec = np.zeros(size, dtype='float32')
-        for scan in IT(scans):
-            raw = self.get_raw_raw_data(scan)
-            rawv = struct.unpack('<{}I'.format(len(raw)//4), raw)
-            k = 0
-            while k<len(rawv):
-                b = rawv[k]
-                if b& 0xc0000000:
-                    x = b & 0x0fffffff
-                    y = rawv[k+1] & 0x0fffffff
-                    dt = dts[x]
-                    #fp = dt%1
-                    ip = int(dt)
-                    k += 3
-                    i = (self.size['pixels']['x']//pixel_aggregation)*(y//pixel_aggregation)+x//pixel_aggregation
-                else:
-                    j1 = rev[b-ip]
-                    if j1<0:
-                        j1 = closest_arg(tx, b-ip)
-                    #j2 = closest_arg(tx, b-ip-1)
-                    spec[i][j1] += 1
-                    #if j2>0:
-                    #    spec[i][j2] += fp
-                    k += 1   
+        spec = self._map_scans(_raw_spectra_per_pixel, scans, workers=workers, prog=prog, dts=dts, rev=rev, tx=tx,
+            binning=pixel_aggregation, width=shape[1], size=size, sparse=sparse)
         if prog:
             pb.update(1)
             pb.set_postfix({'task':'smooth spectra'})
@@ -936,15 +1377,19 @@ class ITM:
         return result
 
     @alias("getRawSpectrum")
-    def get_raw_spectrum(self, scans=None, ROI=None, FOVcorr=True, deadTimeCorr=True, **kargs):
+    @cached
+    def get_raw_spectrum(self, scans=None, ROI=None, FOVcorr=True, deadTimeCorr=True, workers=None, binning=1, **kargs):
         """
         Reconstruct the spectrum from RAW data.
         scans: List of scans to use. if None all scans are used (default)
         ROI: Region Of Interest. It can be:
             1) None: All pixels are used
-            2) A list of images. The pixels will be added to the spectrum i if the value of the i-th image is True for that pixel
+            2) A list of images (or a 3D array). The pixels will be added to the spectrum i if the value of the i-th image is True for that pixel
             3) An image with integer value. The current pixels will be added to the i-th spectrum if the value of ROI at that pixel is i.
+            All the ROI spectra are computed at once, so that hundreds of (possibly overlapping) ROIs can be used.
+        binning: The ROI are defined on the image binned by binning x binning pixels (or bx x by if a tuple (bx, by) is given)
         FOVcorr: Correction for the primary time of flight variation
+        workers: If larger than 1, the scans are processed in parallel by a pool of workers processes
         
         Δt = (√2/2)∙x∙√(mp/(2∙E)) where x is the x-corrdinate (in m), mp, the primary ion mass (in kg) and E the primary energy
         as E=½∙mp∙v² ⇒ v = √(2E/mp)
@@ -960,31 +1405,9 @@ class ITM:
         see Ref. T. Stephan, J. Zehnpfenning and A. Benninghoven, J. vac. Sci. A 12 (2), 1994
  
         """
-        from .utils import get_mass, constants as const
         if ROI is None and 'roi' in kargs:
             ROI = kargs['roi']
-            
-        gun = self.root.goto('propend/Instrument.PrimaryGun.Species').get_key_value()['string'] # Primary Gun Species (Bi1,Bi3,Bi3++)
-        
-        # if the + is missing in the name, add it
-        if gun[-1]!='+':
-            gun += '+'
-            
-        Q = gun.count('+') # number of charge
-        
-        nrj = self.root.goto('propend/Instrument.PrimaryGun.Energy').get_key_value()['float'] # Primary ion energy (in eV)
-        dx = self.size['real']['x']/self.size['pixels']['x'] # distance per pixel
-        
-        # Calculate the mass of the primary ion
-        mp = get_mass(gun)
-            
-        # Perform the time of flight correction?
-        if FOVcorr:
-            DT = dx*(1/5e-11)*.5*np.sqrt(2)*np.sqrt((1e-3*mp/const.NA)/(Q*2*nrj*const.qe)) # delta time in channel per pixel. The 5e-11 is the channelwidth (50ps)
-            # sqrt(2)/2 is from the sin(45°), nrj=E=.5*mp*v^2
-        else:
-            DT = 0
-            
+
         if scans is None:
             scans = range(self.Nscan)
             
@@ -994,78 +1417,16 @@ class ITM:
         number_channels = int(round(self.root.goto('propend/Measurement.CycleTime').get_key_value()['float']\
             / self.root.goto('propend/Registration.TimeResolution').get_key_value()['float']))
         
-        if kargs.get('prog',False):
-            T = PB(scans)
-        else:
-            T = scans
         if kargs.get('debug', False):
             import time
             t0 = time.time()
-        dts = DT*(self.size['pixels']['x']/2-np.arange(self.size['pixels']['x'])) # time correction for the given x coordinate (in channel number)
-        if ROI is None:
-            Spectrum = np.zeros(number_channels, dtype=np.float32)
-            for s in T:
-                raw = self.get_raw_raw_data(s)
-                rawv = struct.unpack('<{}I'.format(len(raw)//4), raw)
-                i = 0
-                while i < len(rawv):
-                    b = rawv[i]
-                    if b & 0xc0000000:
-                        x = b & 0x0fffffff
-                        dt = dts[x]
-                        ip = int(dt)
-                        fp = dt%1
-                        i += 3
-                    else:
-                        Spectrum[b-ip] += (1-fp)
-                        Spectrum[b-ip-1] += fp
-                        i += 1
-        elif type(ROI) is np.ndarray:
+        dts = self._get_time_shift() if FOVcorr else None # time correction for the given x coordinate (in channel number)
+        if type(ROI) is np.ndarray and ROI.ndim == 2:
             assert np.min(ROI)>=0
-            Spectrum = np.zeros((number_channels, np.max(ROI)+1), dtype=np.float32)
-            for s in T:
-                raw = self.get_raw_raw_data(s)
-                rawv = struct.unpack('<{}I'.format(len(raw)//4), raw)
-                i = 0
-                while i < len(rawv):
-                    b = rawv[i]
-                    if b & 0xc0000000:
-                        x = b & 0x0fffffff
-                        y = rawv[i+1] & 0x0fffffff
-                        dt = dts[x]
-                        fp = dt%1
-                        ip = int(dt)
-                        id = ROI[y, x]
-                        i += 3
-                    else:
-                        Spectrum[b-ip, id] += (1-fp)
-                        Spectrum[b-ip-1, id] += fp
-                        i += 1
-        elif type(ROI) in [list, tuple]:
-            multi_roi = True
-            Spectrum = np.zeros((number_channels, len(ROI)), dtype=np.float32)
-            for s in T:
-                raw = self.get_raw_raw_data(s)
-                rawv = struct.unpack('<{}I'.format(len(raw)//4), raw)
-                i = 0
-                while i < len(rawv):
-                    b = rawv[i]
-                    if b & 0xc000000000:
-                        x = b & 0x0fffffff
-                        y = rawv[i+1] & 0x0fffffff
-                        dt = dts[x]
-                        fp = dt%1
-                        ip = int(dt)
-                        li = []
-                        for k, R in enumerate(ROI):
-                            if R[y,x]:
-                                li.append(k)
-                        i += 3
-                    else:
-                        for k in li:
-                                Spectrum[b-ip, k] += (1-fp)
-                                Spectrum[b-ip-1, k] += fp
-                        i += 1
+        Spectrum = self._map_scans(_raw_spectrum, scans, workers=workers, prog=kargs.get('prog', False),
+            dts=dts, number_channels=number_channels, roi=None if ROI is None else _roi_lookup(ROI), binning=binning)
+        if ROI is None:
+            Spectrum = Spectrum[:, 0]
         if kargs.get('debug', False):
             t1 = time.time()
             print("Sepctra calc. time: ", t1-t0)
@@ -1074,16 +1435,10 @@ class ITM:
         k0 = kargs.get('k0', self.root.goto('MassScale/k0').get_double())
         masses = self.channel2mass(np.arange(number_channels), sf=sf, k0=k0)
         if deadTimeCorr:
+            from .utils import dead_time_correction
             dt = 1300 # 65ns*(1ch/50ps) = 1300 channels
             N = self.Nscan*self.size['pixels']['x']*self.size['pixels']['y'] # total of count events
-            Np = np.zeros(Spectrum.shape)
-            if Spectrum.ndim>1:
-                for i in range(Spectrum.shape[1]):
-                    Np[:,i] = N-np.convolve(Spectrum[:, i], np.ones(dt-1, dtype=int), 'full')[:-dt+2]
-            else:
-                Np = N-np.convolve(Spectrum, np.ones(dt-1,dtype=int), 'full')[:-dt+2]
-            Np[Np==0] = 1
-            Spectrum = -N*np.log(1-Spectrum/Np)
+            Spectrum = dead_time_correction(Spectrum, N, dt)
         if kargs.get('debug', False):
             t1 = time.time()
             print("Dead time correction time: ", t1-t0)
@@ -1092,70 +1447,405 @@ class ITM:
             return np.arange(number_channels), Spectrum
         return masses, Spectrum
 
-    @alias("getRawRawData")
-    def get_raw_raw_data(self, scan=0):
-        assert scan < self.Nscan
-        found = False
-        RAW = b''
+    def get_raw_index(self, save=False):
+        """
+        Return the index of the raw data blocks of each scan.
+        The index is built in one pass over the rawdata list at first access.
+        If a saved index (see pySPM.ITM.save_raw_index) matching the file is found alongside the file, it is loaded instead.
+
+        Parameters
+        ----------
+        save : bool
+            If True the index is saved alongside the file
+
+        Returns
+        -------
+        dict
+            A dictionary where the keys are the scan numbers and the values are dictionaries with
+            the keys '  14' (raw data) and '  20' (parameters) giving each a list of (offset, length) of the blocks.
+        """
+        if self.rawindex is None:
+            try:
+                self.rawindex = self.load_raw_index()
+            except (IOError, ValueError, KeyError):
+                self.rawindex = self._create_raw_index()
+        if save:
+            self.save_raw_index()
+        return self.rawindex
+
+    def _create_raw_index(self):
         if self.rawlist is None:
             self.rawlist = self.root.goto('rawdata').get_list()
-        startFound = False
+        index = {}
+        scan = None
         for x in self.rawlist:
             if x['name'] == '   6':
-                if not startFound:
-                    startFound = x['id'] == scan
-                else:
-                    break
-            elif startFound and x['name'] == '  14':
-                self.root.f.seek(x['bidx'])
-                child = Block.Block(self.root.f)
-                RAW += zlib.decompress(child.value)
+                scan = x['id']
+                index[scan] = {'  14': [], '  20': []}
+            elif scan is not None and x['name'] in ['  14', '  20']:
+                index[scan][x['name']].append((x['bidx'], x['blen']))
+        return index
+
+    def _raw_index_filename(self, filename=None):
+        if filename is None:
+            filename = self.filename+".rawindex.npz"
+        return filename
+
+    def save_raw_index(self, filename=None):
+        """
+        Save the raw data index (see pySPM.ITM.get_raw_index) to a file.
+        By default the index is saved alongside the ITM file (same filename with the .rawindex.npz extension).
+        """
+        index = self.get_raw_index()
+        rows = [(scan, int(name), offset, length) for scan in index for name in index[scan] for offset, length in index[scan][name]]
+        stat = os.stat(self.filename)
+        np.savez(self._raw_index_filename(filename), index=np.array(rows, dtype=np.uint64).reshape((-1, 4)),
+            scans=np.array(list(index.keys()), dtype=np.uint64), stat=np.array([stat.st_size, stat.st_mtime]))
+
+    def load_raw_index(self, filename=None):
+        """
+        Load a raw data index saved by pySPM.ITM.save_raw_index.
+        A ValueError is raised if the saved index does not match the current file (different size or modification time).
+        """
+        stat = os.stat(self.filename)
+        with np.load(self._raw_index_filename(filename)) as data:
+            if tuple(data['stat']) != (stat.st_size, stat.st_mtime):
+                raise ValueError("The raw index does not match the file \"{}\"".format(self.filename))
+            index = {int(scan): {'  14': [], '  20': []} for scan in data['scans']}
+            for scan, name, offset, length in data['index'].tolist():
+                index[scan]['{:4d}'.format(name)].append((offset, length))
+        return index
+
+    def set_block_cache(self, max_bytes):
+        """
+        Set the byte budget of the LRU cache of the decompressed blocks. Use 0 to disable it.
+        """
+        Block.set_decompress_cache(self.f, max_bytes)
+
+    def get_block_cache_stats(self):
+        """
+        Return the statistics of the LRU cache of the decompressed blocks
+        as a dictionary with the keys hits, misses, entries, size and max_bytes (see pySPM.Block.DecompressCache.stats)
+        """
+        return Block.get_decompress_cache(self.f).stats()
+
+    def get_toc(self, save=False):
+        """
+        Return the table of contents of the file (see pySPM.Block.read_toc).
+        The table is built in one sequential pass over the file at first access, or loaded from its sidecar file
+        if one matching the file is found (see pySPM.ITM.save_toc). It is then used for all the subsequent navigation in the file.
+
+        Parameters
+        ----------
+        save : bool
+            If True the table of contents is saved alongside the file when it is built
+
+        Returns
+        -------
+        numpy structured array
+            One row per block with the fields offset, type, id, N, length1, length2, next, name and path
+        """
+        if self.toc is None:
+            try:
+                Block.set_toc(self.f, *self.load_toc())
+            except (IOError, ValueError, KeyError):
+                Block.set_toc(self.f, *Block.read_toc(self.f))
+                if save:
+                    try:
+                        self.save_toc()
+                    except IOError:
+                        warn("The table of contents cannot be saved alongside the file")
+        return self.toc[0]
+
+    @property
+    def toc(self):
+        """
+        The table of contents (blocks, children) of the file (see pySPM.ITM.get_toc) or None if it was not built yet.
+        It is kept in the navigation cache of the file, so that it is dropped whenever the file is modified.
+        """
+        return Block.get_cache(self.f).get('toc')
+
+    def _toc_filename(self, filename=None):
+        if filename is None:
+            filename = self.filename+".toc.npz"
+        return filename
+
+    def save_toc(self, filename=None):
+        """
+        Save the table of contents (see pySPM.ITM.get_toc) to a file.
+        By default it is saved alongside the file (same filename with the .toc.npz extension).
+        """
+        if self.toc is None:
+            self.get_toc()
+        stat = os.stat(self.filename)
+        np.savez(self._toc_filename(filename), blocks=self.toc[0], children=self.toc[1], stat=np.array([stat.st_size, stat.st_mtime]))
+
+    def load_toc(self, filename=None):
+        """
+        Load a table of contents saved by pySPM.ITM.save_toc.
+        A ValueError is raised if it does not match the current file (different size or modification time).
+        """
+        stat = os.stat(self.filename)
+        with np.load(self._toc_filename(filename)) as data:
+            if tuple(data['stat']) != (stat.st_size, stat.st_mtime):
+                raise ValueError("The table of contents does not match the file \"{}\"".format(self.filename))
+            return data['blocks'], data['children']
+
+    def _get_scan_offsets(self, scan):
+        return [offset for offset, length in self.get_raw_index().get(scan, {'  14': []})['  14']]
+
+    def _scan_sources(self, scans):
+        """
+        Return (exported, worker, source, offsets) telling where the events of the scans are read from:
+        the exported events (see pySPM.ITM.export_events) if they contain all the scans or the raw data otherwise.
+        """
+        exported = self.events is not None and set(scans) <= set(self.events.get_scans())
+        if exported:
+            return exported, _events_worker, self.events.path, list(scans)
+        return exported, _raw_worker, self.filename, [self._get_scan_offsets(s) for s in scans]
+
+    def _map_scans(self, func, scans, workers=None, prog=False, reduce=True, chunk_events=2**22, **kargs):
+        """
+        Apply func(events, **kargs) to the decoded raw events of each scan.
+
+        Parameters
+        ----------
+        func : function
+            A module-level function (so that it can be sent to worker processes) taking as first argument the events dictionary (see pySPM.ITM.decode_raw_data)
+            and adding its result in place to the accumulator given by its out argument (see pySPM.ITM._reduce_scans)
+        scans : list of int
+            The scans to process
+        workers : None or int
+            If larger than 1, the scans are distributed to a pool of workers processes. Each of them opens its own file handle.
+            If the events were exported (see pySPM.ITM.export_events), they are read from the exported columns instead of the raw data.
+        prog : bool
+            Display a progressbar
+        reduce : bool
+            If True the sum of the results of all scans is returned, otherwise a list with the result of each scan
+        chunk_events : int
+            The events are streamed by batches of at most chunk_events and func is called for each of them.
+            func should thus be additive.
+
+        Returns
+        -------
+        The sum of the results (or None if no scans are given) or a list of the results of each scan
+        """
+        scans = list(scans)
+        if not workers or workers <= 1:
+            exported, _, _, offsets = self._scan_sources(scans)
+            if prog:
+                offsets = PB(offsets, leave=False)
+            if exported:
+                return _reduce_scans((self.events.iter_scan(s, chunk_events) for s in offsets), func, kargs, reduce)
+            return _process_scans(self.root.f, offsets, func, kargs, reduce, chunk_events)
+        if not reduce:
+            res = [None]*len(scans)
+            for k, r in self._map_scan_groups(func, [[s] for s in scans], workers=workers, prog=prog, chunk_events=chunk_events, **kargs):
+                res[k] = r
+            return res
+        # Each task gets a contiguous group of scans which is reduced locally by the worker
+        # and the results are summed as soon as they are computed
+        groups = [g.tolist() for g in np.array_split(np.array(scans), min(len(scans), 4*workers)) if len(g)>0]
+        res = None
+        for _, r in self._map_scan_groups(func, groups, workers=workers, prog=prog, chunk_events=chunk_events, **kargs):
+            if res is None:
+                res = r
+            else:
+                res += r
+        return res
+
+    def _map_scan_groups(self, func, groups, workers=None, prog=False, chunk_events=2**22, **kargs):
+        """
+        Apply func(events, **kargs) to the decoded raw events of each group of scans (see pySPM.ITM._map_scans)
+        and yield (index of the group, sum of the results of its scans) as soon as each group is computed.
+
+        If workers is larger than 1, a single pool of worker processes is used for all the groups with one task per group.
+        At most 2*workers tasks are in flight, so that only a few results are kept in memory, and the results are yielded
+        in the order of completion.
+        """
+        if not workers or workers <= 1:
+            steps = enumerate(groups)
+            if prog:
+                steps = PB(steps, total=len(groups), leave=False)
+            for k, g in steps:
+                yield k, self._map_scans(func, g, chunk_events=chunk_events, **kargs)
+            return
+        from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+        _, worker, source, offsets = self._scan_sources(sum(groups, []))
+        if prog:
+            pb = PB(total=len(groups), leave=False)
+        running = {}
+        j = k = 0
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            while k < len(groups) or running:
+                while k < len(groups) and len(running) < 2*workers:
+                    running[executor.submit(worker, source, offsets[j:j+len(groups[k])], func, kargs, True, chunk_events)] = k
+                    j += len(groups[k])
+                    k += 1
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    if prog:
+                        pb.update(1)
+                    yield running.pop(fut), fut.result()
+        if prog:
+            pb.close()
+
+    def iter_events(self, scans=None, chunk_events=2**22):
+        """
+        Iterate over the raw events by batches of a fixed size.
+        The raw data are decompressed and decoded incrementally, so that the memory usage stays bounded whatever the file size is.
+
+        Parameters
+        ----------
+        scans : None or list of int
+            The scans to read. If None all the scans are read.
+        chunk_events : int
+            The number of events of each batch (the last one can be smaller)
+
+        Returns
+        -------
+        generator of dict
+            Each batch is a dictionary of 1D numpy arrays (see pySPM.ITM.decode_raw_data) with the keys
+            scan, x, y, id and channel.
+
+        Example
+        -------
+        >>> A = pySPM.ITM("myfile.itm")
+        >>> S = np.zeros(10000)
+        >>> for ev in A.iter_events():
+        >>>     S += np.bincount(ev['channel'], minlength=10000)[:10000]
+        """
+        if scans is None:
+            scans = range(self.Nscan)
+        batch = []
+        n = 0
+        for s in scans:
+            for ev in _iter_raw_events(self.root.f, self._get_scan_offsets(s), 4*chunk_events):
+                if len(ev['channel']) == 0:
+                    continue
+                ev['scan'] = np.full(len(ev['channel']), s, dtype=np.uint32)
+                batch.append(ev)
+                n += len(ev['channel'])
+                while n >= chunk_events:
+                    ev = _concat_events(batch)
+                    yield {k: ev[k][:chunk_events] for k in ev}
+                    batch = [{k: ev[k][chunk_events:] for k in ev}]
+                    n -= chunk_events
+        if n > 0:
+            yield _concat_events(batch)
+
+    def export_events(self, path, scans=None, FOVcorr=False, chunk_events=2**22, attach=True, prog=False):
+        """
+        Decode once the raw data and export the events in a columnar format which can be memory-mapped (see pySPM.ITMEvents).
+        The events of each scan are written by shards of at most chunk_events events as uncompressed .npy files (one per column)
+        in the directory path together with a meta.npz file.
+
+        Parameters
+        ----------
+        path : string
+            The output directory (created if needed)
+        scans : None or list of int
+            The scans to export. If None all the scans are exported.
+        FOVcorr : bool
+            If True an additional column "time" (float32) with the time corrected for the primary ion time of flight
+            (in channel unit, see get_raw_spectrum) is exported
+        chunk_events : int
+            Maximal number of events per shard
+        attach : bool
+            If True the exported events are used for all the subsequent raw data analysis (get_raw_spectrum, spectra_per_pixel, reconstruct, ...)
+        prog : bool
+            Display a progressbar
+
+        Returns
+        -------
+        pySPM.ITMEvents
+        """
+        if scans is None:
+            scans = range(self.Nscan)
+        if not os.path.exists(path):
+            os.makedirs(path)
+        if FOVcorr:
+            dts = self._get_time_shift()
+        shards = []
+        columns = list(ITMEvents.columns)+(['time'] if FOVcorr else [])
+        if prog:
+            scans = PB(scans)
+        for s in scans:
+            for ev in self.iter_events(scans=[s], chunk_events=chunk_events):
+                if FOVcorr:
+                    ev['time'] = _fov_time(ev, dts).astype(np.float32)
+                for k in columns:
+                    np.save(os.path.join(path, '{}_{:05d}.npy'.format(k, len(shards))), ev[k])
+                shards.append((s, len(ev['channel'])))
+        stat = os.stat(self.filename)
+        np.savez(os.path.join(path, 'meta.npz'),
+            filename=os.path.abspath(self.filename),
+            stat=np.array([stat.st_size, stat.st_mtime]),
+            shards=np.array(shards, dtype=np.int64).reshape((-1, 2)),
+            columns=np.array(columns),
+            size=np.array([self.size['pixels']['x'], self.size['pixels']['y']]),
+            Nscan=self.Nscan)
+        events = ITMEvents(path)
+        if attach:
+            self.events = events
+        return events
+
+    def load_events(self, path):
+        """
+        Use the events exported by export_events in the directory path for all the subsequent raw data analysis.
+        """
+        events = ITMEvents(path)
+        stat = os.stat(self.filename)
+        if events.stat != [stat.st_size, stat.st_mtime]:
+            raise ValueError("The exported events do not match the file \"{}\"".format(self.filename))
+        self.events = events
+        return events
+
+    def _get_time_shift(self, FOVcorr=True):
+        """
+        Return the correction (in channel unit) of the primary ion time of flight for each x coordinate.
+
+        Δt = (√2/2)∙x∙√(mp/(2∙E)) where x is the x-corrdinate (in m), mp, the primary ion mass (in kg) and E the primary energy
+        """
+        from .utils import get_mass, constants as const
+        if not FOVcorr:
+            return np.zeros(self.size['pixels']['x'])
+        gun = self.root.goto('propend/Instrument.PrimaryGun.Species').get_key_value()['string'] # Primary Gun Species (Bi1,Bi3,Bi3++)
+        # if the + is missing in the name, add it
+        if gun[-1]!='+':
+            gun += '+'
+        Q = gun.count('+') # number of charge
+        nrj = self.root.goto('propend/Instrument.PrimaryGun.Energy').get_key_value()['float'] # Primary ion energy (in eV)
+        dx = self.size['real']['x']/self.size['pixels']['x'] # distance per pixel
+        # Calculate the mass of the primary ion
+        mp = get_mass(gun)
+        DT = dx*(1/5e-11)*.5*np.sqrt(2)*np.sqrt((1e-3*mp/const.NA)/(Q*2*nrj*const.qe)) # delta time in channel per pixel. The 5e-11 is the channelwidth (50ps)
+        # sqrt(2)/2 is from the sin(45°), nrj=E=.5*mp*v^2
+        return DT*(self.size['pixels']['x']/2-np.arange(self.size['pixels']['x'])) # time correction for the given x coordinate (in channel number)
+
+    @alias("getRawRawData")
+    def get_raw_raw_data(self, scan=0):
+        assert scan < self.Nscan
+        RAW = _read_raw(self.root.f, self._get_scan_offsets(scan))
         if type(RAW) is str:
             return bytearray(RAW)
         return RAW
 
     def get_pixel_order(self, scan=0):
-        raw = self.get_raw_raw_data(scan)
-        rawv = struct.unpack('<{}I'.format(len(raw)//4), raw)
+        _, pixels = decode_raw_data(self.get_raw_raw_data(scan), pixels=True)
         pixel_order = np.zeros((self.size['pixels']['y'], self.size['pixels']['x']))
-        i = 0
-        while i < len(rawv):
-            b = rawv[i]
-            if b & 0xc0000000:
-                x = b & 0x0fffffff
-                y = rawv[i+1] & 0x0fffffff
-                id = rawv[i+2] & 0x3fffffff
-                pixel_order[y,x] = id
-                i += 3
-            else:
-                i += 1
+        pixel_order[pixels['y'], pixels['x']] = pixels['id']
         return pixel_order
         
     @alias("getRawData")
     def get_raw_data(self, scan=0):
         """
         Function which allows you to read and parse the raw data.
-        It return a dictionary of list where each key is the pixel position (x,y) and the value is the list of all times (channel number).
-        """
-        raw = self.get_raw_raw_data(scan)
-        rawv = struct.unpack('<{}I'.format(len(raw)//4), raw)
-        blocks = {}
-        i = 0
-        _block = []
-        x,y = -1,-1
-        while i < len(rawv):
-            b = rawv[i]
-            if b & 0xc0000000:
-                blocks[(x,y)] = _block # Somehow it's faster to append the data to a list first and then attribute it to the dict
-                x = b & 0x0fffffff
-                y = rawv[i+1] & 0x0fffffff
-                _block = []
-                i += 3
-            else:
-                _block.append(b)
-                i += 1
-        del blocks[(-1,-1)]
-        return blocks
+        It return a dictionary of arrays where each key is the pixel position (x,y) and the value is the array of all times (channel number).
+        """
+        ev, pixels = decode_raw_data(self.get_raw_raw_data(scan), pixels=True)
+        times = np.split(ev['channel'], np.cumsum(pixels['count'])[:-1])
+        return {(x, y): t for x, y, t in zip(pixels['x'].tolist(), pixels['y'].tolist(), times)}
 
     def show_masses(self, mass_list=None):
         """
@@ -1182,9 +1872,7 @@ class ITM:
             import matplotlib.pyplot as plt
             fig, ax = plt.subplots(1, 1, figsize=(W*10/H, 10))
 
-        Dat = zlib.decompress(self.root.goto(
-            'SampleHolderInfo/bitmap/imagedata').value)
-        I = np.array(struct.unpack("<"+str(W*H*3)+"B", Dat), dtype=np.uint8).reshape((H, W, 3))
+        I = self.root.goto('SampleHolderInfo/bitmap/imagedata').get_array('B', (H, W, 3))
         ax.imshow(I)
         if markers:
             X = self.root.goto('Meta/SI Image[0]/stageposition_x').get_double()
@@ -1221,7 +1909,7 @@ class ITM:
             dl = self.root.goto('Meta/Video Snapshot').dict_list()
             sx = dl['res_x']['ulong']
             sy = dl['res_y']['ulong']
-            img = np.array(self.root.goto('Meta/Video Snapshot/imagedata').get_data('B')).reshape((sy, sx, 3))
+            img = self.root.goto('Meta/Video Snapshot/imagedata').get_array('B', (sy, sx, 3)).copy()
             return  img
         except Exception as e:
             return None
@@ -1237,14 +1925,28 @@ class ITM:
                 print("{0}) {cmass:.2f}u [{lmass:.2f}u-{umass:.2f}u]".format(p, cmass=P['cmass']['float'],lmass=P['lmass']['float'],umass=P['umass']['float']))
             
     def modify_block_and_export(self, path, new_data, output, reload=True, **kargs):
-        self.root.modify_block_and_export(path, new_data, output, **kargs)
+        self.modify_blocks_and_export({path: new_data}, output, reload=reload, **kargs)
+
+    def modify_blocks_and_export(self, changes, output, reload=True, **kargs):
+        """
+        Export the file to output with the values of several blocks replaced (see pySPM.Block.Block.modify_blocks_and_export).
+        changes is a dictionary {path: new_data}. If reload is True, the exported file is then opened instead of the current one.
+        """
+        if self.toc is not None and not self.f.writable():
+            kargs.setdefault('toc', self.toc)
+        self.root.modify_blocks_and_export(changes, output, **kargs)
         if reload:
+            block_cache = Block.get_decompress_cache(self.f).max_bytes
+            Block.close_mmap(self.f)
             self.f.close()
-            self.f.open(path, "rb+")
+            self.filename = output
+            self.f = open(output, "rb+")
+            Block.set_decompress_cache(self.f, block_cache)
             self.f.read(8)
             self.root = Block.Block(self.f)
+            self.rawindex = None
 
-    def reconstruct(self, channels, scans=None, sf=None, k0=None, prog=False, time=False):
+    def reconstruct(self, channels, scans=None, sf=None, k0=None, prog=False, time=False, workers=None, FOVcorr=False, binning=1):
         """
         Reconstruct an Image from a raw spectra by defining the lower and upper mass
         channels: list of (lower_mass, upper_mass)
@@ -1253,6 +1955,9 @@ class ITM:
         sf/k0: mass calibration. If none take the saved values
         time: If true the upper/lower_mass will be understood as time value
         prog: If True display a progressbar with tqdm
+        workers: If larger than 1, the scans are processed in parallel by a pool of workers processes
+        FOVcorr: If True the times are corrected for the primary ion time of flight (as in get_raw_spectrum)
+        binning: The pixels are binned by groups of binning x binning pixels (or bx x by if a tuple (bx, by) is given)
         """
         from .utils import mass2time
         from . import SPM_image
@@ -1263,8 +1968,6 @@ class ITM:
             assert len(c)==2
         if scans is None:
             scans = range(self.Nscan)
-        if prog:
-            scans = PB(scans)
         left = np.array([x[0] for x in channels])
         right = np.array([x[1] for x in channels])
         if not time:
@@ -1272,18 +1975,147 @@ class ITM:
                 sf, k0 = self.get_mass_cal()
             left = mass2time(left, sf=sf, k0=k0)
             right = mass2time(right, sf=sf, k0=k0)
-        Counts = [np.zeros((self.size['pixels']['x'], self.size['pixels']['y'])) for x in channels]
-        for s in scans:
-            Data = self.get_raw_data(s)
-            for xy in Data:
-                for i,ch in enumerate(channels):
-                    Counts[i][xy[1],xy[0]] += np.sum((Data[xy]>=left[i])*(Data[xy]<=right[i]))
+        Counts = self._map_scans(_raw_images, scans, workers=workers, prog=prog, left=left, right=right,
+            shape=_binned_shape((self.size['pixels']['y'], self.size['pixels']['x']), binning),
+            dts=self._get_time_shift() if FOVcorr else None, binning=binning)
         res = [SPM_image(C, real=self.size['real'], _type='TOF', channel="{0[0]:.2f}{unit}-{0[1]:.2f}{unit}".format(channels[i],unit=["u", "s"][time]), zscale="Counts") for i,C in enumerate(Counts)]
         if len(res) == 1:
             return res[0]
             return res[0]
         return res
         
+    def reconstruct_volume(self, channels, scans=None, bin_z=1, bin_xy=1, sf=None, k0=None, time=False, FOVcorr=False,
+            dtype=np.float64, filename=None, prog=False, workers=None):
+        """
+        Reconstruct the 3D (scan, y, x) volumes of several mass windows from the raw data in one streaming pass over the events.
+
+        Parameters
+        ----------
+        channels : list of (lower_mass, upper_mass)
+            The mass windows (which can overlap)
+        scans : list of int
+            The scans (if None, all scans are taken)
+        bin_z : int
+            Number of consecutive scans summed in each slice of the volume
+        bin_xy : int or (int, int)
+            The pixels are binned by groups of bin_xy x bin_xy (or bx x by)
+        sf, k0 : float
+            Mass calibration. If None the saved values are taken
+        time : bool
+            If True the window boundaries are understood as time values (in channel unit)
+        FOVcorr : bool
+            Correction for the primary ion time of flight (see pySPM.ITM.reconstruct)
+        dtype : numpy dtype
+            The data type of the volume (e.g. np.uint16 to reduce its size). The counts are clipped to the range of integer types.
+        filename : None or string
+            If given, the volume is written to a memory-mapped .npy file (see numpy.lib.format.open_memmap),
+            so that volumes larger than the RAM can be reconstructed. Only a few slices are kept in memory at a time.
+        prog : bool
+            Display a progressbar
+        workers : None or int
+            If larger than 1, the scans are processed in parallel by a pool of workers processes
+
+        Returns
+        -------
+        numpy array (or memmap) of shape (number of windows, number of slices, height, width)
+        """
+        from .utils import mass2time
+        assert hasattr(channels, '__iter__')
+        if not hasattr(channels[0], '__iter__'):
+            channels = [channels]
+        if scans is None:
+            scans = range(self.Nscan)
+        scans = list(scans)
+        left = np.array([x[0] for x in channels], dtype=float)
+        right = np.array([x[1] for x in channels], dtype=float)
+        if not time:
+            if sf is None or k0 is None:
+                sf, k0 = self.get_mass_cal()
+            left = mass2time(left, sf=sf, k0=k0)
+            right = mass2time(right, sf=sf, k0=k0)
+        shape = _binned_shape((self.size['pixels']['y'], self.size['pixels']['x']), bin_xy)
+        slices = _scan_groups(scans, bin_z)
+        vshape = (len(left), len(slices))+shape
+        if filename is None:
+            volume = np.zeros(vshape, dtype=dtype)
+        else:
+            volume = np.lib.format.open_memmap(filename, mode='w+', dtype=dtype, shape=vshape)
+        kargs = dict(left=left, right=right, shape=shape, dts=self._get_time_shift() if FOVcorr else None, binning=bin_xy)
+        vmax = np.iinfo(dtype).max if np.issubdtype(dtype, np.integer) else None
+        # Each slice is written as soon as it is computed, so that only a few slices are kept in memory
+        for z, V in self._map_scan_groups(_raw_images, slices, workers=workers, prog=prog, **kargs):
+            if vmax is not None:
+                if np.max(V) > vmax:
+                    warn("Some counts exceed the range of {} and are clipped".format(np.dtype(dtype).name))
+                V = np.clip(np.round(V), 0, vmax)
+            volume[:, z] = V
+        if filename is not None:
+            volume.flush()
+        return volume
+
+    def get_raw_profile(self, channels, scans=None, sf=None, k0=None, time=False, FOVcorr=True, spectra=False, bin_z=1, prog=False, workers=None):
+        """
+        Depth profile computed from the raw data: the number of counts of each scan in each mass window.
+        All the windows (and optionally the spectrum of each scan) are computed in a single pass over the events.
+
+        Parameters
+        ----------
+        channels : list of (lower_mass, upper_mass)
+            The mass windows (which can overlap)
+        scans : list of int
+            The scans (if None, all scans are taken)
+        sf, k0 : float
+            Mass calibration. If None the saved values are taken
+        time : bool
+            If True the window boundaries are understood as time values (in channel unit)
+        FOVcorr : bool
+            Correction for the primary ion time of flight (see pySPM.ITM.get_raw_spectrum)
+        spectra : bool
+            If True the spectrum of each scan is returned as well
+        bin_z : int
+            Number of consecutive scans summed in each row of the profile
+        prog : bool
+            Display a progressbar
+        workers : None or int
+            If larger than 1, the scans are processed in parallel by a pool of workers processes
+
+        Returns
+        -------
+        profile : numpy array
+            The counts of shape (number of scan groups, number of windows) (float64 with FOVcorr, int64 otherwise)
+        spectra : numpy array
+            Only if spectra is True. The spectra of each scan group, of shape (number of scan groups, number of channels)
+            (float32 with FOVcorr, uint32 otherwise)
+        """
+        from .utils import mass2time
+        assert hasattr(channels, '__iter__')
+        if not hasattr(channels[0], '__iter__'):
+            channels = [channels]
+        if scans is None:
+            scans = range(self.Nscan)
+        left = np.array([x[0] for x in channels], dtype=float)
+        right = np.array([x[1] for x in channels], dtype=float)
+        if not time:
+            if sf is None or k0 is None:
+                sf, k0 = self.get_mass_cal()
+            left = mass2time(left, sf=sf, k0=k0)
+            right = mass2time(right, sf=sf, k0=k0)
+        number_channels = 0
+        if spectra:
+            number_channels = int(round(self.get_value("Measurement.CycleTime")['float']/self.get_value("Registration.TimeResolution")['float']))
+        groups = _scan_groups(scans, bin_z)
+        # Only the result of each scan group is kept. The counts are integers unless they are split by the FOV correction,
+        # and the (large) spectra are stored in single precision.
+        profile = np.zeros((len(groups), len(left)), dtype=np.float64 if FOVcorr else np.int64)
+        spec = np.zeros((len(groups), number_channels), dtype=np.float32 if FOVcorr else np.uint32)
+        for k, r in self._map_scan_groups(_raw_profile, groups, workers=workers, prog=prog, left=left, right=right,
+                dts=self._get_time_shift() if FOVcorr else None, channels=number_channels):
+            profile[k] = r[:len(left)]
+            spec[k] = r[len(left):]
+        if spectra:
+            return profile, spec
+        return profile
+
     def create_new_miblock(self, assign, lmass=None, umass=None, cmass=None, desc="", _uuid=None, **kargs):
         import uuid
         if _uuid is None:
@@ -1317,28 +2149,29 @@ class ITM:
             'attr.Visible':('B', 1)
             }
         p = dict(new_index=new_index, new_index2=new_index2)
-        self.root.edit_block("Measurement Options/massintervals/mi[{new_index2}]".format(**p), "id", struct.pack("<I", new_id))
-        self.root.edit_block("MassIntervalList/mi[{new_index}]".format(**p), "id", struct.pack("<I", new_id))
-        for path in ["Measurement Options/massintervals/mi[{new_index2}]","MassIntervalList/mi[{new_index}]"]:
-            self.root.edit_block(path.format(**p), "desc", desc.encode('utf16')[2:])
-            self.root.edit_block(path.format(**p), "SN", _uuid.encode('utf16')[2:])
-            self.root.edit_block(path.format(**p), "assign", assign.encode('utf16')[2:])
-            self.root.edit_block(path.format(**p), "lmass", struct.pack("<d", lmass))
-            self.root.edit_block(path.format(**p), "umass", struct.pack("<d", umass))
-            if cmass is None:
-                cmass = (lmass+umass)/2
-            self.root.edit_block(path.format(**p), "cmass", struct.pack("<d", cmass))
-            self.root.edit_block(path.format(**p), "desc", desc.encode('utf16')[2:])
-            for key in defaults:
-                data = kargs.get(key, defaults[key][1])
-                fmt = defaults[key][0]
-                if fmt == 'utf16':
-                    data = data.encode('utf16')[2:]
-                elif fmt=='raw':
-                    pass
-                else:
-                    data = struct.pack("<"+fmt, data)
-                self.root.edit_block(path.format(**p), key, data)
+        with Block.BlockWriter(self.root) as w:
+            w.edit_block("Measurement Options/massintervals/mi[{new_index2}]".format(**p), "id", struct.pack("<I", new_id))
+            w.edit_block("MassIntervalList/mi[{new_index}]".format(**p), "id", struct.pack("<I", new_id))
+            for path in ["Measurement Options/massintervals/mi[{new_index2}]","MassIntervalList/mi[{new_index}]"]:
+                w.edit_block(path.format(**p), "desc", desc.encode('utf16')[2:])
+                w.edit_block(path.format(**p), "SN", _uuid.encode('utf16')[2:])
+                w.edit_block(path.format(**p), "assign", assign.encode('utf16')[2:])
+                w.edit_block(path.format(**p), "lmass", struct.pack("<d", lmass))
+                w.edit_block(path.format(**p), "umass", struct.pack("<d", umass))
+                if cmass is None:
+                    cmass = (lmass+umass)/2
+                w.edit_block(path.format(**p), "cmass", struct.pack("<d", cmass))
+                w.edit_block(path.format(**p), "desc", desc.encode('utf16')[2:])
+                for key in defaults:
+                    data = kargs.get(key, defaults[key][1])
+                    fmt = defaults[key][0]
+                    if fmt == 'utf16':
+                        data = data.encode('utf16')[2:]
+                    elif fmt=='raw':
+                        pass
+                    else:
+                        data = struct.pack("<"+fmt, data)
+                    w.edit_block(path.format(**p), key, data)
         blk = self.root.goto("MassIntervalList/mi[{new_index}]".format(**p))
         d = blk.dict_list()
         self.peaks[d['id']['long']] = d
@@ -1348,6 +2181,7 @@ class ITM:
         if self.f.writable():
             self.f.flush()
             os.fsync(self.f)
+        Block.close_mmap(self.f)
         self.f.close()
 
     @alias("setK0")
@@ -10,14 +10,14 @@ from . import align, utils
 from .nanoscan import Nanoscan
 from .Bruker import Bruker
 from .collection import Collection
-from .ITM import ITM
+from .ITM import ITM, ITMEvents
 from .ITS import ITS
 from .ITAX import ITAX
 from .ITA import ITA, ITA_collection
 from .SXM import SXM
 from .utils import constants as const
 
-__all__ = ["ITA", "ITAX", "ITS", "ITM", "PCA", "Block", "SPM", "Bruker", "nanoscan", "utils", "SXM"]
+__all__ = ["ITA", "ITAX", "ITS", "ITM", "ITMEvents", "PCA", "Block", "SPM", "Bruker", "nanoscan", "utils", "SXM"]
 __version__ = '0.2.21'
 __author__ = 'Olivier Scholder'
 __copyright__ = "Copyright 2018, O. Scholder, Zürich, Switzerland"
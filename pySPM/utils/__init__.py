@@ -11,7 +11,7 @@ from .elts import *
 from .constants import *
 from .spectra import *
 from .plot import *
-from . import fit, misc, colors
+from . import fit, misc, colors, cache
 from .save import *
 from .restoration import *
 from .misc import alias, PB
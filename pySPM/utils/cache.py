@@ -0,0 +1,177 @@
+# -- coding: utf-8 --
+
+"""
+On-disk cache of the results of expensive computations performed on ITM/ITA files (raw spectra, spectra per pixel, ...).
+
+The results are stored as compressed .npz files in a cache directory. Their name is a hash (content address) of
+the file path, size and modification time, of the function name and arguments and of the state of the object
+(mass calibration, ...), so that a result is never reused if any of them changes.
+The least recently used results are removed when the total size of the cache exceeds a given size.
+
+The cached methods are decorated with cached and the cache is enabled by the cache attribute of the object
+(e.g. pySPM.ITM(filename, cache=True)).
+"""
+
+import os
+import pickle
+import hashlib
+import tempfile
+import functools
+import inspect
+import numpy as np
+
+cache_dir = os.path.join(os.path.expanduser('~'), '.cache', 'pySPM')
+cache_size = 2**30
+
+# Attributes of the objects which influence the results of their methods
+state_attributes = ['sf', 'k0', 'scale']
+
+def set_cache_dir(path=None, max_size=None):
+    """
+    Set the default cache directory and/or its maximum size (in bytes)
+    """
+    global cache_dir, cache_size
+    if path is not None:
+        cache_dir = path
+    if max_size is not None:
+        cache_size = max_size
+
+def _update_hash(h, obj):
+    if isinstance(obj, np.ndarray):
+        h.update(b'ndarray'+str(obj.dtype).encode()+str(obj.shape).encode())
+        h.update(np.ascontiguousarray(obj).tobytes())
+    elif isinstance(obj, (list, tuple)):
+        h.update(type(obj).__name__.encode())
+        for x in obj:
+            _update_hash(h, x)
+            h.update(b',')
+    elif isinstance(obj, dict):
+        h.update(b'dict')
+        for k in sorted(obj, key=repr):
+            _update_hash(h, k)
+            _update_hash(h, obj[k])
+    else:
+        h.update(repr(obj).encode())
+
+def get_key(filename, name, args, state=None):
+    """
+    Return the cache key of the result of the function name with the arguments args (dictionary) computed on the file filename
+    """
+    from .. import __version__
+    stat = os.stat(filename)
+    h = hashlib.sha1()
+    _update_hash(h, (__version__, os.path.abspath(filename), stat.st_size, stat.st_mtime_ns, name, args, state))
+    return h.hexdigest()
+
+def _path(key, path=None):
+    return os.path.join(path or cache_dir, key+'.npz')
+
+def load(key, path=None):
+    """
+    Load a cached result. A KeyError is raised if it is not found.
+    """
+    filename = _path(key, path)
+    try:
+        with np.load(filename, allow_pickle=False) as data:
+            kind = str(data['kind'])
+            if kind == 'array':
+                res = data['a0']
+            elif kind == 'tuple':
+                res = tuple(data['a{}'.format(i)] for i in range(len(data.files)-1))
+            else:
+                res = pickle.loads(data['pickle'].tobytes())
+    except (IOError, ValueError, KeyError, pickle.UnpicklingError, EOFError):
+        raise KeyError(key)
+    os.utime(filename) # mark as recently used
+    return res
+
+def store(key, result, path=None, max_size=None):
+    """
+    Store a result in the cache and remove the least recently used results if the cache exceeds max_size bytes
+    """
+    path = path or cache_dir
+    if not os.path.exists(path):
+        os.makedirs(path)
+    if isinstance(result, np.ndarray) and result.dtype != object:
+        data = dict(kind='array', a0=result)
+    elif isinstance(result, tuple) and all(isinstance(x, np.ndarray) and x.dtype != object for x in result):
+        data = dict(kind='tuple', **{'a{}'.format(i): x for i, x in enumerate(result)})
+    else:
+        data = dict(kind='pickle', pickle=np.frombuffer(pickle.dumps(result, pickle.HIGHEST_PROTOCOL), dtype=np.uint8))
+    # write in a temporary file first, so that an interrupted write never leaves a corrupted result
+    fd, temp = tempfile.mkstemp(suffix='.tmp', dir=path)
+    with os.fdopen(fd, 'wb') as f:
+        np.savez_compressed(f, **data)
+    os.replace(temp, _path(key, path))
+    shrink(path, max_size)
+
+def shrink(path=None, max_size=None):
+    """
+    Remove the least recently used results until the cache size is at most max_size bytes
+    """
+    path = path or cache_dir
+    if max_size is None:
+        max_size = cache_size
+    files = []
+    for name in os.listdir(path):
+        if name.endswith('.npz'):
+            st = os.stat(os.path.join(path, name))
+            files.append((st.st_mtime, st.st_size, name))
+    total = sum(x[1] for x in files)
+    for _, size, name in sorted(files):
+        if total <= max_size:
+            break
+        try:
+            os.remove(os.path.join(path, name))
+        except OSError:
+            pass
+        total -= size
+
+def clear(path=None):
+    """
+    Remove all the cached results
+    """
+    shrink(path, 0)
+
+def cached(func=None, ignore=('prog', 'workers')):
+    """
+    Decorator caching on disk the results of a method of an object having a filename attribute (e.g. pySPM.ITM).
+    The cache is only used if the attribute cache of the object is True (default directory) or a directory path.
+    The arguments listed in ignore do not influence the result and are not part of the cache key.
+
+    Usage:
+        @cached
+        def get_raw_spectrum(self, scans=None, ...):
+            ...
+    """
+    if func is None:
+        return functools.partial(cached, ignore=ignore)
+    signature = inspect.signature(func)
+    @functools.wraps(func)
+    def wrapper(self, *args, **kargs):
+        cache = getattr(self, 'cache', False)
+        if not cache:
+            return func(self, *args, **kargs)
+        path = cache if isinstance(cache, str) else None
+        bound = signature.bind(self, *args, **kargs)
+        bound.apply_defaults()
+        arguments = {}
+        for k, v in list(bound.arguments.items())[1:]:
+            if signature.parameters[k].kind == inspect.Parameter.VAR_KEYWORD:
+                arguments.update({kk: vv for kk, vv in v.items() if kk not in ignore})
+            elif k not in ignore:
+                arguments[k] = v
+        state = {k: getattr(self, k) for k in state_attributes if hasattr(self, k)}
+        key = get_key(self.filename, type(self).__name__+'.'+func.__name__, arguments, state)
+        try:
+            return load(key, path)
+        except KeyError:
+            pass
+        result = func(self, *args, **kargs)
+        try:
+            store(key, result, path)
+        except (IOError, OSError, pickle.PicklingError):
+            from warnings import warn
+            warn("The result of {} cannot be cached".format(func.__name__))
+        return result
+    return wrapper
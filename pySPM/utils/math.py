@@ -317,3 +317,61 @@ def Voigt(x, x0, sig, gamma, A=1):
     out = scipy.signal.convolve(L, G, 'same')
     out /= np.max(out)
     return A*out
+
+def _add_shifted(out, V, dx, dy, w=1):
+    """
+    out[..., y, x] += w*V[..., y+dy, x+dx] for all the pixels where y+dy and x+dx are inside the image.
+    dx and dy are integers.
+    """
+    sy, sx = V.shape[-2:]
+    if abs(dx) >= sx or abs(dy) >= sy:
+        return
+    dst = (Ellipsis, slice(max(0, -dy), sy-max(0, dy)), slice(max(0, -dx), sx-max(0, dx)))
+    src = (Ellipsis, slice(max(0, dy), sy+min(0, dy)), slice(max(0, dx), sx+min(0, dx)))
+    if w == 1:
+        out[dst] += V[src]
+    else:
+        out[dst] += w*V[src]
+
+def shift_sum(stack, shifts, out=None):
+    """
+    Sum a stack of images after shifting each of them.
+    out[..., y, x] = Σ_s stack[..., s, y+dy_s, x+dx_s]
+    The pixels shifted out of the images are discarded (no wrap around, no temporary shifted copies).
+    Sub-pixel shifts are performed with bilinear interpolation and the images having the same shift are summed before being shifted.
+
+    Parameters
+    ----------
+    stack : numpy array
+        array of shape (..., scans, y, x)
+    shifts : list of tuples or array of shape (scans, 2)
+        the shift (dx, dy) in pixels of each scan
+    out : None or numpy array
+        the accumulator of shape (..., y, x). If None a new float64 array is created.
+
+    Returns
+    -------
+    numpy array of shape (..., y, x)
+    """
+    stack = np.asarray(stack)
+    if out is None:
+        out = np.zeros(stack.shape[:-3]+stack.shape[-2:])
+    shifts = np.asarray(shifts, dtype=np.float64).reshape((-1, 2))
+    assert len(shifts) == stack.shape[-3]
+    groups, inverse = np.unique(shifts, axis=0, return_inverse=True)
+    inverse = np.ravel(inverse)
+    for k, (dx, dy) in enumerate(groups):
+        scans = np.nonzero(inverse == k)[0]
+        if len(scans) == 1:
+            V = stack[..., scans[0], :, :]
+        else:
+            V = stack[..., scans, :, :].sum(axis=-3)
+        ix = int(np.floor(dx))
+        iy = int(np.floor(dy))
+        fx = dx-ix
+        fy = dy-iy
+        for x, wx in [(ix, 1-fx), (ix+1, fx)]:
+            for y, wy in [(iy, 1-fy), (iy+1, fy)]:
+                if wx*wy > 0:
+                    _add_shifted(out, V, x, y, wx*wy)
+    return out
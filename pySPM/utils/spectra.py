@@ -394,3 +394,41 @@ def plot_isotopes(elt, amp=None, main=None, ax=None, sig=None, asym=None, lg=0,
     ax.plot(m+dm, s, color, **kargs);
     return m, s
     
+
+def dead_time_correction(spectrum, n_shots, dead_channels=1300, axis=0):
+    """
+    Dead time correction (Poisson statistics) of a spectrum.
+
+    Icorr(c) = -N*log(1-I(c)/N'(c))
+    where N'(c) = N - sum_{c'=c-dead_channels+2}^{c} I(c') is the number of shots for which the detector was still able to count at channel c.
+    The sliding sums are computed with cumulative sums, so that the cost does not depend on the dead time.
+
+    see Ref. T. Stephan, J. Zehnpfenning and A. Benninghoven, J. vac. Sci. A 12 (2), 1994
+
+    Parameters
+    ----------
+    spectrum : numpy array
+        The spectrum (counts per channel). It can have more dimensions (e.g. several ROI spectra or an image stack),
+        all the spectra being corrected at once.
+    n_shots : int or numpy array
+        The number of primary ion shots N. An array (e.g. one value per pixel) should be broadcastable to the spectrum without its channel axis.
+    dead_channels : int
+        The dead time in channel unit (65ns = 1300 channels of 50ps)
+    axis : int
+        The channel axis of spectrum
+
+    Returns
+    -------
+    The corrected spectrum (same shape as spectrum)
+    """
+    import numpy as np
+    S = np.moveaxis(np.asarray(spectrum, dtype=np.float64), axis, 0)
+    w = min(max(dead_channels-1, 0), S.shape[0])
+    window = np.cumsum(S, axis=0)
+    if w == 0:
+        window[:] = 0
+    else:
+        window[w:] -= window[:-w].copy()
+    Np = n_shots-window
+    Np[Np==0] = 1
+    return np.moveaxis(-n_shots*np.log(1-S/Np), 0, axis)
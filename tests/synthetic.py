@@ -0,0 +1,115 @@
+"""
+Small synthetic ITStr files (ITM/ITA) used by the tests
+"""
+
+import struct
+import zlib
+import numpy as np
+from pySPM import Block
+
+def key_value(key, i=0, f=0.0, s=''):
+    """
+    Encode a parameter as found in the propend/propstart blocks
+    """
+    k = key.encode('utf-16-le')
+    sv = s.encode('utf-16-le')
+    return b'\0'*16 + struct.pack('<I', len(k)) + k + struct.pack('<2xqd', i, f) + struct.pack('<I', len(sv)) + sv
+
+def make_root(path):
+    """
+    Create an empty ITStr file and return its opened root Block
+    """
+    size = 53*100
+    with open(path, 'wb') as f:
+        f.write(b'ITStrF01')
+        f.write(struct.pack("<B6I", 1, 25, 0, 0, 0, size, size))
+        f.write(struct.pack("<2IB6IQ{}x".format(size-41), size, 100, 0, 0, 0, 0, 0, 0, 0, 0))
+    f = open(path, 'r+b')
+    f.seek(8)
+    return Block.Block(f)
+
+def make_itm(path, sx=16, sy=16, nscan=3, nch=4000, chunks=3, ita=False, seed=0):
+    """
+    Write a synthetic ITM file with random raw data (split in chunks '  14' blocks per scan).
+    If ita is True, three mass intervals and their (per scan and added) images are written as well.
+    Return the list of the (scan, x, y, channel) of all the events
+    """
+    rng = np.random.RandomState(seed)
+    root = make_root(path)
+    root.edit_block('Meta/SI Image', 'res_x', struct.pack('<i', sx))
+    root.edit_block('Meta/SI Image', 'res_y', struct.pack('<i', sy))
+    root.edit_block('Meta/SI Image', 'fieldofview', struct.pack('<d', 100e-6))
+    root.edit_block('Meta/SI Image', 'intensdata', zlib.compress(struct.pack('<{}f'.format(sx*sy), *rng.rand(sx*sy))), _type=128)
+    props = {
+        'Instrument.Analyzer_Polarity_Switch': dict(s='Positive'),
+        'Instrument.PrimaryGun.Species': dict(s='Bi1'),
+        'Instrument.PrimaryGun.Energy': dict(f=30000.),
+        'Measurement.CycleTime': dict(f=nch*5e-11),
+        'Registration.TimeResolution': dict(f=5e-11),
+        'Registration.Raster.ShotsPerPixel': dict(i=1),
+        'Measurement.ScanNumber': dict(i=nscan),
+        'Registration.Raster.Resolution': dict(i=sx),
+        'Registration.Raster.FieldOfView': dict(f=100e-6),
+    }
+    for k, v in props.items():
+        for d in ['propend', 'propstart']:
+            root.edit_block(d, k, key_value(k, **v))
+    root.edit_block('MassScale', 'sf', struct.pack('<d', 2000.))
+    root.edit_block('MassScale', 'k0', struct.pack('<d', 10.))
+    root.edit_block('rawdata', '   2', b'')
+    events = []
+    for s in range(nscan):
+        root.edit_block('rawdata', '   6', struct.pack('<I', s), id=s)
+        words = []
+        for y in range(sy):
+            for x in range(sx):
+                words += [x | 0xC0000000, y | 0xD0000000, (s*sx*sy+y*sx+x) | 0x40000000]
+                channels = rng.randint(5, nch-5, rng.poisson(3))
+                words += list(channels)
+                events += [(s, x, y, c) for c in channels]
+        words = np.array(words, dtype='<u4').tobytes()
+        cut = [0]+sorted(rng.randint(1, len(words)//4, chunks-1)*4)+[len(words)]
+        for j in range(chunks):
+            root.edit_block('rawdata', '  14', zlib.compress(words[cut[j]:cut[j+1]]), id=s*chunks+j, _type=128)
+            root.edit_block('rawdata', '  20', key_value('Instrument.LMIG.Emission_Current', f=1e-6*(1+j+s))[16:], id=s*chunks+j)
+    root.edit_block('rawdata', '   3', b'\x00')
+    if ita:
+        base = 'filterdata/TofCorrection/ImageStack/Reduced Data/ImageStackScans'
+        added = 'filterdata/TofCorrection/ImageStack/Reduced Data/ImageStackScansAdded'
+        root.edit_block(base, 'Image.NumberOfImages', struct.pack('<I', 3))
+        root.edit_block(base, 'Image.XSize', struct.pack('<I', sx))
+        root.edit_block(base, 'Image.YSize', struct.pack('<I', sy))
+        root.edit_block(base, 'Image.NumberOfScans', struct.pack('<I', nscan))
+        for c in range(3):
+            total = np.zeros(sx*sy, dtype='<u4')
+            for s in range(nscan):
+                img = rng.randint(0, 10, sx*sy).astype('<u4')
+                total += img
+                root.edit_block(base+'/Image[{}]'.format(c), 'ImageArray.Long', zlib.compress(img.tobytes()), id=s, _type=128)
+            root.edit_block(added+'/Image[{}]'.format(c), 'ImageArray.Long', zlib.compress(total.tobytes()), _type=128)
+            p = 'MassIntervalList/mi[{}]'.format(c)
+            root.edit_block(p, 'id', struct.pack('<i', c))
+            root.edit_block(p, 'desc', 'd{}'.format(c).encode('utf-16-le'))
+            root.edit_block(p, 'assign', ['', '', 'Au-'][c].encode('utf-16-le'))
+            root.edit_block(p, 'SN', 'sn{}'.format(c).encode('utf-16-le'))
+            for k, v in zip(['lmass', 'cmass', 'umass'], [10*c+1, 10*c+1.5, 10*c+2]):
+                root.edit_block(p, k, struct.pack('<d', v))
+        shifts = np.array([[0, 0], [1, -2], [-1, 1]][:nscan], dtype='<i4')
+        root.edit_block(base+'/ShiftCoordinates', 'ImageStack.ShiftCoordinates', zlib.compress(shifts.tobytes()), _type=128)
+    root.f.close()
+    return events
+
+def tree(block, path=''):
+    """
+    Return the list of (path, type, value) of all the blocks below block (used to compare files)
+    """
+    res = []
+    for e in block.get_list():
+        child = block.goto_item(e['name'], e['id'])
+        p = '{}/{}[{}]'.format(path, e['name'], e['id'])
+        if child.Type[0] in [1, 3]:
+            res.append((p, child.Type[0], None))
+            res += tree(child, p)
+        else:
+            res.append((p, child.Type[0], bytes(child.value)))
+    return res
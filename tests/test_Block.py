@@ -0,0 +1,228 @@
+from pySPM import Block, ITM
+from synthetic import make_itm, make_root, tree
+import numpy as np
+import tempfile
+import struct
+import os
+
+import unittest
+
+class TestToc(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.dir.name, 'test.itm')
+        make_itm(self.filename, nscan=2)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_paths(self):
+        A = ITM(self.filename)
+        blocks = A.get_toc()
+        paths = blocks['path'].tolist()
+        assert '/rawdata/  14[1]' in paths
+        for path, offset in zip(paths, blocks['offset'].tolist()):
+            if path:
+                assert A.root.goto(path).offset == offset
+
+    def test_edit(self):
+        A = ITM(self.filename, readonly=False, index=True)
+        assert A.toc is not None
+        A.root.edit_block('MassScale', 'new', b'abc')
+        # the table of contents is dropped when the file is modified
+        assert A.toc is None
+        A.get_toc()
+        assert 'new' in [x['name'] for x in A.root.goto('MassScale').get_list()]
+        assert '/MassScale/new' in A.get_toc()['path'].tolist()
+        A.f.close()
+
+class TestDecompressCache(unittest.TestCase):
+    def test_lru(self):
+        C = Block.DecompressCache(max_bytes=25)
+        for offset in range(3):
+            assert C.get(offset, lambda: b'x'*10) == b'x'*10
+        # the first value was evicted to stay within the budget
+        assert list(C.data) == [1, 2] and C.size == 20
+        C.get(1, lambda: b'')
+        C.get(3, lambda: b'y'*5)
+        assert list(C.data) == [2, 1, 3] and C.size == 25
+        # too large values are not cached
+        C.get(4, lambda: b'z'*30)
+        assert 4 not in C.data and C.size == 25
+        assert C.stats() == dict(hits=1, misses=5, entries=3, size=25, max_bytes=25)
+        C.resize(12)
+        assert list(C.data) == [3] and C.size == 5
+        C.clear()
+        assert C.size == 0 and len(C.data) == 0
+
+class TestRead(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.dir.name, 'test.ita')
+        make_itm(self.filename, sx=4, sy=4, nscan=2, ita=True)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_mmap(self):
+        with open(self.filename, 'rb') as f, open(self.filename, 'rb') as g:
+            Block.open_mmap(g)
+            f.seek(8)
+            g.seek(8)
+            assert tree(Block.Block(f)) == tree(Block.Block(g))
+            Block.close_mmap(g)
+
+    def test_pread(self):
+        from concurrent.futures import ThreadPoolExecutor
+        with open(self.filename, 'rb') as f:
+            data = f.read()
+            f.seek(123)
+            ranges = [(o, n) for o in range(0, len(data), 997) for n in [1, 25, 4000]]
+            with ThreadPoolExecutor(4) as pool:
+                res = list(pool.map(lambda r: Block.pread(f, *r), ranges))
+            assert res == [data[o:o+n] for o, n in ranges]
+            # the file position is not modified
+            assert f.tell() == 123
+
+    def test_get_array(self):
+        with open(self.filename, 'rb') as f:
+            f.seek(8)
+            root = Block.Block(f)
+            img = root.goto('filterdata/TofCorrection/ImageStack/Reduced Data/ImageStackScans/Image[1]/ImageArray.Long[1]')
+            A = img.get_array('I', (4, 4))
+            assert A.dtype == np.dtype('<u4') and A.shape == (4, 4)
+            assert A.tolist() == np.frombuffer(img.decompress(), dtype='<u4').reshape((4, 4)).tolist()
+            sf = root.goto('MassScale/sf')
+            assert sf.get_array('d', decompress=False).tolist() == [2000.]
+            # explicit byte order
+            B = sf.get_array('>u2', decompress=False)
+            assert B.dtype == np.dtype('>u2') and B.shape == (4,)
+            assert B.tolist() == [struct.unpack('>H', sf.value[i:i+2])[0] for i in range(0, 8, 2)]
+
+    def test_prefetch(self):
+        import zlib
+        with open(self.filename, 'rb') as f:
+            f.seek(8)
+            root = Block.Block(f)
+            base = root.goto('filterdata/TofCorrection/ImageStack/Reduced Data/ImageStackScans')
+            blocks = [base.goto('Image[{}]/ImageArray.Long[{}]'.format(c, s)) for c in [2, 0, 1] for s in [1, 0]]
+            offsets = [b.offset for b in blocks]
+            expected = [zlib.decompress(b.value) for b in blocks]
+            for workers in [None, 1, 3]:
+                assert list(Block.prefetch(f, offsets, workers=workers, depth=2)) == expected
+            assert list(Block.prefetch(f, offsets, decompress=False)) == [bytes(b.value) for b in blocks]
+
+    def test_goto_cache(self):
+        with open(self.filename, 'r+b') as f:
+            f.seek(8)
+            root = Block.Block(f)
+            assert root.goto('MassScale/sf').get_double() == 2000.
+            assert len(Block.get_cache(f)['paths']) > 0
+            root.edit_block('MassScale', 'sf', struct.pack('<d', 3000.))
+            root.edit_block('MassScale', 'new', b'abc')
+            # the resolved paths and children lists are dropped after an edit
+            assert root.goto('MassScale/sf').get_double() == 3000.
+            assert root.goto('MassScale/new').value == b'abc'
+            # a block replaced by a larger one is found at its new location
+            root.edit_block('MassScale', 'new', b'abcdef', force=True)
+            assert root.goto('MassScale/new').value == b'abcdef'
+
+class TestBlockWriter(unittest.TestCase):
+    edits = [
+        [('MassScale', 'sf', struct.pack('<d', 3000.), {}), # rewrite
+         ('MassScale', 'new', b'abc', {}), # new child
+         ('New/Dir', 'b', b'1', {}), # new directories
+         ('New/Dir', 'a', b'22', {}),
+         ('New/Dir[2]', 'a', b'333', {'id': 1})],
+        [('Meta/SI Image', 'res_x', struct.pack('<q', 16), {'force': True}), # replaced by a larger block
+         ('New/Dir', 'c', b'4444', {}),
+         ('MassScale', 'new', b'xyz', {})],
+    ]
+
+    def test_commit(self):
+        with tempfile.TemporaryDirectory() as path:
+            trees = []
+            for writer in [False, True]:
+                filename = os.path.join(path, 'test{}.itm'.format(writer))
+                make_itm(filename, sx=4, sy=4, nscan=1)
+                with open(filename, 'r+b') as f:
+                    f.seek(8)
+                    root = Block.Block(f)
+                    W = Block.BlockWriter(root)
+                    for edits in self.edits:
+                        for p, name, value, kargs in edits:
+                            if writer:
+                                W.edit_block(p, name, value, **kargs)
+                            else:
+                                root.edit_block(p, name, value, **kargs)
+                        # the same writer is reused for the second set of edits
+                        W.commit()
+                with open(filename, 'rb') as f:
+                    f.seek(8)
+                    trees.append(tree(Block.Block(f)))
+            assert trees[0] == trees[1]
+            assert ('/New[0]/Dir[0]/c[0]', 0, b'4444') in trees[1]
+
+def export_reference(filename, path, new_data, output):
+    """
+    Block by block copy of a file with one block replaced (previous implementation of Block.modify_block_and_export)
+    """
+    with open(filename, 'rb') as f, open(output, 'wb') as out:
+        f.seek(8)
+        block = Block.Block(f).goto(path)
+        diff = len(new_data)-block.head['length1']
+        size = os.fstat(f.fileno()).st_size
+        out.write(b'ITStrF01')
+        offset = 8
+        while offset < size:
+            f.seek(offset)
+            head = f.read(25)
+            name_length, N, length1 = struct.unpack('<5xI4xII4x', head)
+            name = f.read(name_length)
+            value = f.read(length1)
+            if offset == block.offset:
+                out.write(head[:17]+struct.pack('<2I', length1+diff, length1+diff)+name+new_data)
+            elif head[0] in [1, 3]:
+                value = bytearray(value)
+                nxt = struct.unpack_from('<Q', value, 33)[0]
+                if nxt > block.offset:
+                    struct.pack_into('<Q', value, 33, nxt+diff)
+                for i in range(N):
+                    entry = list(struct.unpack_from('<B4I2Q', value, 41+33*i))
+                    if entry[6] == block.offset:
+                        entry[5] = len(new_data)
+                    elif entry[6] > block.offset:
+                        entry[6] += diff
+                    struct.pack_into('<B4I2Q', value, 41+33*i, *entry)
+                out.write(head+name+bytes(value))
+            else:
+                out.write(head+name+value)
+            offset += 25+name_length+length1
+
+class TestExport(unittest.TestCase):
+    def test_export(self):
+        with tempfile.TemporaryDirectory() as path:
+            filename = os.path.join(path, 'test.itm')
+            make_itm(filename, nscan=2)
+            changes = [('MassScale/k0', b'longer value'), ('rawdata/  14[4]', b'')]
+            def read(name):
+                with open(os.path.join(path, name), 'rb') as f:
+                    return f.read()
+            # one block
+            export_reference(filename, *changes[0], output=os.path.join(path, 'ref1.itm'))
+            A = ITM(filename)
+            A.root.modify_block_and_export(*changes[0], output=os.path.join(path, 'out1.itm'))
+            assert read('out1.itm') == read('ref1.itm')
+            # several blocks
+            export_reference(os.path.join(path, 'ref1.itm'), *changes[1], output=os.path.join(path, 'ref2.itm'))
+            A = ITM(filename, block_cache=1234)
+            A.modify_blocks_and_export(dict(changes), os.path.join(path, 'out2.itm'), reload=True)
+            assert read('out2.itm') == read('ref2.itm')
+            # the exported file is reloaded with the same block cache budget
+            assert A.filename == os.path.join(path, 'out2.itm')
+            assert A.root.goto('MassScale/k0').value == b'longer value'
+            assert A.get_block_cache_stats()['max_bytes'] == 1234
+            A.f.close()
+
+if __name__ == "__main__":
+    unittest.main()
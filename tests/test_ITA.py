@@ -3,6 +3,8 @@ import numpy as np
 import matplotlib.pyplot as plt
 
 import os
+import tempfile
+from synthetic import make_itm
 data = os.path.join(os.path.dirname(__file__), "AuTi_Img_Bi1_p_4_0.ita")
 
 import unittest
@@ -24,5 +26,21 @@ class TestITA(unittest.TestCase):
         assert CH[0]['assign'] == 'Ag+'
         assert np.all(img1.pixels == img2.pixels)
 
+class TestImageCube(unittest.TestCase):
+    def test_image_cube(self):
+        with tempfile.TemporaryDirectory() as path:
+            filename = os.path.join(path, 'test.ita')
+            make_itm(filename, sx=5, sy=4, nscan=3, ita=True)
+            A = pySPM.ITA(filename)
+            for workers in [None, 1]:
+                cube = A.get_image_cube(workers=workers)
+                assert cube.shape == (3, 3, 4, 5)
+                for c in range(3):
+                    for s in range(3):
+                        assert np.all(cube[c, s] == A.get_image(c, s))
+            sub = A.get_image_cube(channels=[2, 0], scans=1)
+            assert np.all(sub[:, 0] == cube[[2, 0], 1])
+            A.f.close()
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
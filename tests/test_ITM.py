@@ -0,0 +1,151 @@
+from pySPM.ITM import ITM, decode_raw_data, _raw_images, _RawEventStream, _fov_split, _raw_spectra_per_pixel, _raw_spectrum, _roi_lookup
+from synthetic import make_itm
+import numpy as np
+import tempfile
+import os
+
+import unittest
+
+def raw_scan(pixels):
+    """
+    Encode a list of (x, y, id, [channels]) in the iontof raw data format
+    """
+    words = []
+    for x, y, i, channels in pixels:
+        words += [x | 0xC0000000, y | 0xD0000000, i | 0x40000000] + list(channels)
+    return np.array(words, dtype='<u4').tobytes()
+
+class TestRawData(unittest.TestCase):
+    pixels = [(0, 0, 0, [10, 12]), (1, 0, 1, []), (2, 0, 2, []), (0, 1, 3, [5]), (1, 1, 4, [7, 8, 9])]
+
+    def test_decode(self):
+        ev, pix = decode_raw_data(raw_scan(self.pixels), pixels=True)
+        assert list(ev['channel']) == [10, 12, 5, 7, 8, 9]
+        assert list(ev['x']) == [0, 0, 0, 1, 1, 1]
+        assert list(ev['y']) == [0, 0, 1, 1, 1, 1]
+        assert list(ev['id']) == [0, 0, 3, 4, 4, 4]
+        assert list(pix['id']) == [0, 1, 2, 3, 4]
+        assert list(pix['count']) == [2, 0, 0, 1, 3]
+
+    def test_decode_empty(self):
+        ev = decode_raw_data(b'')
+        assert len(ev['channel']) == 0
+
+    def test_stream(self):
+        raw = raw_scan(self.pixels)
+        ev = decode_raw_data(raw)
+        for size in [1, 5, 7, 13]:
+            stream = _RawEventStream()
+            parts = []
+            for i in range(0, len(raw), size):
+                parts.append(stream.feed(raw[i:i+size]))
+                # only the last pixel header is kept between the pieces
+                assert len(stream.carry) <= 3
+            for k in ev:
+                assert np.concatenate([p[k] for p in parts]).tolist() == ev[k].tolist()
+
+    def test_images(self):
+        ev = decode_raw_data(raw_scan(self.pixels))
+        # overlapping and empty windows
+        C = _raw_images(ev, np.array([4, 7.5, 9, 11]), np.array([10, 12, 9.5, 10]), (2, 3))
+        assert C.shape == (4, 2, 3)
+        assert C[0].tolist() == [[1, 0, 0], [1, 3, 0]]
+        assert C[1].tolist() == [[2, 0, 0], [0, 2, 0]]
+        assert C[2].tolist() == [[0, 0, 0], [0, 1, 0]]
+        assert C[3].sum() == 0
+        # binned pixels
+        C = _raw_images(ev, np.array([4]), np.array([10]), (1, 2), binning=2)
+        assert C[0].tolist() == [[5, 0]]
+
+    def test_fov_split(self):
+        ev = decode_raw_data(raw_scan(self.pixels))
+        # negative and integer shifts
+        t, w, i = _fov_split(ev, np.array([0.25, -0.5, 2.0]))
+        assert np.isclose(w.sum(), len(ev['channel']))
+        S = np.bincount(t, weights=w, minlength=14)
+        assert np.allclose(S[4:13], [0.25, 0.75, 0, 0.5, 1, 1.25, 1.25, 0.25, 0.75])
+        assert list(np.unique(ev['x'][i])) == [0, 1]
+        t, w, i = _fov_split(ev)
+        assert w is None and list(t) == list(ev['channel'])
+
+    def test_sparse_spectra(self):
+        ev = decode_raw_data(raw_scan(self.pixels))
+        tx = np.array([5, 7, 8, 9, 10, 12])
+        rev = -np.ones(13, dtype=int)
+        rev[tx] = np.arange(len(tx))
+        args = (np.array([0.25, -0.5, 2.0]), rev, tx, 1, 3, (6, len(tx)))
+        D = _raw_spectra_per_pixel(ev, *args)
+        S = _raw_spectra_per_pixel(ev, *args, sparse=True)
+        assert np.allclose(S.toarray(), D)
+        assert np.isclose(D.sum(), len(ev['channel']))
+
+    def test_roi_spectra(self):
+        ev = decode_raw_data(raw_scan(self.pixels))
+        # overlapping masks, one of them empty
+        masks = np.array([[[1, 1, 0], [0, 1, 0]], [[1, 0, 0], [1, 1, 1]], [[0, 0, 0], [0, 0, 0]]], dtype=bool)
+        S = _raw_spectrum(ev, None, 14, roi=_roi_lookup(masks))
+        assert S.shape == (14, 3)
+        for k, R in enumerate(masks):
+            inside = R[ev['y'], ev['x']]
+            assert S[:, k].tolist() == np.bincount(ev['channel'][inside], minlength=14).tolist()
+        labels = np.array([[0, 2, 2], [1, 1, 0]])
+        S = _raw_spectrum(ev, None, 14, roi=_roi_lookup(labels))
+        assert S[:, 0].sum() == 2 and S[:, 1].sum() == 4 and S[:, 2].sum() == 0
+
+class TestFile(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.dir.name, 'test.itm')
+        self.events = np.array(make_itm(self.filename, sx=8, sy=6, nscan=3))
+        self.A = ITM(self.filename)
+
+    def tearDown(self):
+        self.A.f.close()
+        self.dir.cleanup()
+
+    def test_raw_index(self):
+        index = self.A.get_raw_index(save=True)
+        assert sorted(index) == [0, 1, 2] and all(len(index[s]['  14']) == 3 for s in index)
+        B = ITM(self.filename)
+        assert B.load_raw_index() == index
+        B.f.close()
+        for s in range(3):
+            data = self.A.get_raw_data(s)
+            # all the pixels are found, including the last one of the scan
+            assert sorted(data) == [(x, y) for x in range(8) for y in range(6)]
+            ev = self.events[self.events[:, 0] == s]
+            for (x, y), t in data.items():
+                assert t.tolist() == ev[(ev[:, 1] == x)*(ev[:, 2] == y), 3].tolist()
+
+    def test_events(self):
+        path = os.path.join(self.dir.name, 'events')
+        m, S = self.A.get_raw_spectrum(deadTimeCorr=False)
+        self.A.export_events(path, FOVcorr=True, chunk_events=100, attach=False)
+        B = ITM(self.filename)
+        E = B.load_events(path)
+        assert len(E) == len(self.events)
+        assert E.get_column('time').dtype == np.float32
+        assert np.allclose(B.get_raw_spectrum(deadTimeCorr=False)[1], S)
+        assert np.allclose(B.get_raw_spectrum(FOVcorr=False, deadTimeCorr=False)[1], np.bincount(self.events[:, 3], minlength=len(S)))
+        B.f.close()
+        # an export of a modified file is rejected
+        os.utime(self.filename, (0, 0))
+        self.assertRaises(ValueError, self.A.load_events, path)
+
+    def test_profile(self):
+        windows = [(100, 900), (500, 1500), (3000, 3000)]
+        for bin_z in [1, 2]:
+            P, S = self.A.get_raw_profile(windows, time=True, FOVcorr=False, spectra=True, bin_z=bin_z)
+            groups = [[0], [1], [2]] if bin_z == 1 else [[0, 1], [2]]
+            assert P.shape == (len(groups), 3) and S.shape == (len(groups), 4000)
+            for k, g in enumerate(groups):
+                t = self.events[np.isin(self.events[:, 0], g), 3]
+                assert P[k].tolist() == [np.sum((t >= l)*(t <= r)) for l, r in windows]
+                assert S[k].tolist() == np.bincount(t, minlength=4000).tolist()
+        # the FOV correction only splits the events between neighbouring channels
+        P, S = self.A.get_raw_profile(windows, time=True, spectra=True, bin_z=3)
+        assert np.isclose(S.sum(), len(self.events))
+        assert P.dtype == np.float64 and S.dtype == np.float32
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,56 @@
+from pySPM.utils import cache
+import numpy as np
+import tempfile
+import os
+
+import unittest
+
+class Measurement:
+    def __init__(self, filename, path):
+        self.filename = filename
+        self.cache = path
+        self.sf = 1
+        self.calls = 0
+
+    @cache.cached
+    def spectrum(self, n, prog=False):
+        self.calls += 1
+        return np.arange(n)*self.sf, {'n': n}
+
+class TestCache(unittest.TestCase):
+    def test_cached(self):
+        with tempfile.TemporaryDirectory() as path:
+            filename = os.path.join(path, 'data.itm')
+            with open(filename, 'wb') as f:
+                f.write(b'data')
+            M = Measurement(filename, os.path.join(path, 'cache'))
+            a = M.spectrum(5)
+            b = M.spectrum(5, prog=True)
+            assert M.calls == 1
+            assert np.all(a[0] == b[0]) and b[1] == {'n': 5}
+            M.sf = 2
+            assert np.all(M.spectrum(5)[0] == 2*np.arange(5))
+            assert M.calls == 2
+            # a modified file invalidates the results
+            with open(filename, 'ab') as f:
+                f.write(b'more')
+            M.spectrum(5)
+            assert M.calls == 3
+            cache.clear(M.cache)
+            assert os.listdir(M.cache) == []
+
+    def test_store(self):
+        with tempfile.TemporaryDirectory() as path:
+            A = np.random.RandomState(0).rand(100, 100)
+            cache.store('a', A, path)
+            cache.store('b', (A, A[0]), path)
+            assert np.all(cache.load('a', path) == A)
+            assert np.all(cache.load('b', path)[1] == A[0])
+            self.assertRaises(KeyError, cache.load, 'c', path)
+            # least recently used results are removed first
+            os.utime(os.path.join(path, 'a.npz'), (0, 0))
+            cache.shrink(path, os.path.getsize(os.path.join(path, 'b.npz')))
+            assert sorted(os.listdir(path)) == ['b.npz']
+
+if __name__ == "__main__":
+    unittest.main()
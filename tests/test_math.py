@@ -0,0 +1,21 @@
+import pySPM
+import numpy as np
+
+import unittest
+
+class TestShiftSum(unittest.TestCase):
+    def test_integer(self):
+        stack = np.arange(2*4*5).reshape((2, 4, 5))
+        Z = pySPM.utils.shift_sum(stack, [(0, 0), (1, -1)])
+        ref = stack[0].astype(float)
+        ref[1:, :-1] += stack[1, :-1, 1:]
+        assert np.array_equal(Z, ref)
+
+    def test_subpixel(self):
+        stack = np.ones((1, 3, 4))
+        Z = pySPM.utils.shift_sum(stack, [(0.5, 0)])
+        assert np.allclose(Z[:, :-1], 1)
+        assert np.allclose(Z[:, -1], .5)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,18 @@
+import pySPM
+import numpy as np
+
+import unittest
+
+class TestDeadTime(unittest.TestCase):
+    def test_convolve(self):
+        S = np.random.RandomState(0).poisson(.3, (500, 2)).astype(float)
+        N, dt = 400, 50
+        Np = N-np.array([np.convolve(S[:, i], np.ones(dt-1), 'full')[:-dt+2] for i in range(2)]).T
+        ref = -N*np.log(1-S/Np)
+        assert np.allclose(pySPM.utils.dead_time_correction(S, N, dt), ref)
+        # image stack with the channels as last axis
+        stack = S.T.reshape((1, 2, 500))
+        assert np.allclose(pySPM.utils.dead_time_correction(stack, N, dt, axis=-1)[0], ref.T)
+
+if __name__ == "__main__":
+    unittest.main()